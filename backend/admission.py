@@ -0,0 +1,227 @@
+import math
+import shutil
+import time
+import uuid
+
+from PIL import Image
+
+from procinfo import mem_available_mb
+from settings import cfg, r, BASE_DIR
+
+ADMISSION = cfg.get("admission", {})
+ENABLED = bool(ADMISSION.get("enabled", True))
+MAX_QUEUE = int(ADMISSION.get("max_queue", 32))
+MAX_BACKLOG = float(ADMISSION.get("max_backlog", 0))
+MIN_FREE_DISK = int(float(ADMISSION.get("min_free_disk_gb", 0)) * 1024 ** 3)
+DISK_FACTOR = float(ADMISSION.get("disk_factor", 4))
+MIN_FREE_MEM_MB = float(ADMISSION.get("min_free_mem_mb", 0))
+SECONDS_PER_MPX = float(ADMISSION.get("seconds_per_mpx", 2.0))
+SECONDS_PER_IMAGE_EPOCH = float(ADMISSION.get("seconds_per_image_epoch", 1.0))
+SECONDS_PER_IMAGE = float(ADMISSION.get("seconds_per_image", 4.0))
+SECONDS_PER_FLOW = float(ADMISSION.get("seconds_per_flow", 0.5))
+LEASE = int(ADMISSION.get("lease", 21600))
+
+# 计算进程同时执行的任务数，用于把积压耗时换算成等待时间
+CAPACITY = max(1, int(cfg.get("worker", {}).get("workers", 4)))
+
+JOBS_KEY = "admission:jobs"    # 有序集合：令牌 -> 租约到期时间
+COST_KEY = "admission:cost"    # 哈希：令牌 -> 估计耗时（秒）
+RETRY_RESOURCES = 60           # 内存不足时建议的重试间隔（秒）
+MAX_RETRY_AFTER = 3600
+
+
+class Admission:
+    """
+    任务接口的准入控制。
+
+    每个被接受的任务在 redis 中占用一个令牌并记录估计耗时，任务结束时释放；多个 worker 进程共享同一份积压视图。
+    队列长度、积压总耗时、剩余磁盘或可用内存超过限制时拒绝新任务，并根据积压估计 Retry-After。
+    """
+
+    @staticmethod
+    def _pixels(f) -> int:
+        """
+        只读取图片头获取像素数（含多页 tif 的页数），读不出时按文件大小估计。
+        """
+        stream = f.stream
+        stream.seek(0, 2)
+        size = stream.tell()
+        stream.seek(0)
+        try:
+            with Image.open(stream) as im:
+                n = im.width * im.height * getattr(im, "n_frames", 1)
+        except Exception:
+            n = size // 2
+        stream.seek(0)
+        return n
+
+    @classmethod
+    def run_cost(cls, files) -> float:
+        """
+        分割任务的估计耗时（秒），按上传图片的总像素数计算。
+        """
+        pixels = sum(cls._pixels(f) for f in files if f and f.filename)
+        return pixels / 1e6 * SECONDS_PER_MPX
+
+    @staticmethod
+    def quicklook_cost(max_side: int) -> float:
+        """
+        快速预览的估计耗时（秒），预览图最长边不超过 max_side。
+        """
+        return max_side * max_side / 1e6 * SECONDS_PER_MPX
+
+    @staticmethod
+    def batch_cost(n_files: int) -> float:
+        """
+        服务器本地批量分割的估计耗时（秒），按图片数计算，不读取图片。
+        """
+        return n_files * SECONDS_PER_IMAGE
+
+    @staticmethod
+    def resegment_cost(n_flows: int) -> float:
+        """
+        重新分割的估计耗时（秒），按需要重建掩膜的网络输出（.npz）个数计算。
+        """
+        return n_flows * SECONDS_PER_FLOW
+
+    @staticmethod
+    def train_cost(n_images: int, n_epochs: int, n_ranks: int = 1) -> float:
+        """
+        训练任务的估计耗时（秒），按 epoch 数 × 训练图片数计算。
+        """
+        return n_images * n_epochs * SECONDS_PER_IMAGE_EPOCH / max(1, n_ranks)
+
+    @staticmethod
+    def free_mem_mb() -> float | None:
+        return mem_available_mb()
+
+    @staticmethod
+    def _jobs() -> dict[str, float]:
+        """
+        当前占用名额的任务及其估计耗时；租约已过期的令牌视为泄漏并清除。
+        """
+        now = time.time()
+        r.zremrangebyscore(JOBS_KEY, 0, now)
+        tokens = r.zrangebyscore(JOBS_KEY, now, "+inf")
+        if not tokens:
+            return {}
+        costs = r.hmget(COST_KEY, tokens)
+        return {t.decode(): float(c or 0) for t, c in zip(tokens, costs)}
+
+    @staticmethod
+    def _retry_after(seconds: float) -> int:
+        return int(min(max(math.ceil(seconds), 1), MAX_RETRY_AFTER))
+
+    @classmethod
+    def _check_resources(cls, upload_bytes: int = 0) -> dict | None:
+        disk = shutil.disk_usage(BASE_DIR)
+        if disk.free - upload_bytes * DISK_FACTOR < MIN_FREE_DISK:
+            # 等待下一次清理释放空间
+            return {"reason": "disk", "free_disk_gb": disk.free / 1024 ** 3,
+                    "retry_after": cls._retry_after(cfg.get("cleanup", {}).get("interval", 600))}
+
+        mem = cls.free_mem_mb()
+        if mem is not None and mem < MIN_FREE_MEM_MB:
+            return {"reason": "memory", "free_mem_mb": mem, "retry_after": RETRY_RESOURCES}
+        return None
+
+    @classmethod
+    def _check_queue(cls, others: dict[str, float], cost: float) -> dict | None:
+        backlog = sum(others.values())
+        if len(others) >= MAX_QUEUE:
+            # 平均每个任务的耗时 × 需要先完成的任务数，再按并行度折算
+            per_job = backlog / max(len(others), 1)
+            return {"reason": "queue", "queue_length": len(others),
+                    "retry_after": cls._retry_after(per_job * (len(others) - MAX_QUEUE + 1) / CAPACITY)}
+        if MAX_BACKLOG > 0 and others and backlog + cost > MAX_BACKLOG:
+            # 队列为空时总是接受，否则单个大任务永远无法执行
+            return {"reason": "backlog", "backlog_seconds": backlog,
+                    "retry_after": cls._retry_after((backlog + cost - MAX_BACKLOG) / CAPACITY)}
+        return None
+
+    @classmethod
+    def precheck(cls, upload_bytes: int = 0) -> dict | None:
+        """
+        在解析请求体之前的快速检查：只看磁盘、内存与当前队列，不估计任务开销，
+        使过载时不必先接收并解析完整的上传数据就能拒绝。通过后仍需 acquire。
+
+        :param upload_bytes: 请求体大小（Content-Length）
+        :return: 被拒绝时为拒绝原因，否则为 None
+        """
+        if not ENABLED:
+            return None
+        return cls._check_resources(upload_bytes) or cls._check_queue(cls._jobs(), 0)
+
+    @classmethod
+    def acquire(cls, kind: str, cost: float, upload_bytes: int = 0) -> tuple[str | None, dict | None]:
+        """
+        申请执行一个任务。
+
+        :param kind: 任务类型，如 run / train
+        :param cost: 估计耗时（秒）
+        :param upload_bytes: 上传数据大小，用于估计磁盘占用
+        :return: (令牌, None)；被拒绝时为 (None, 拒绝原因)，原因中含 retry_after（秒）
+        """
+        if not ENABLED:
+            return "", None
+
+        rejection = cls._check_resources(upload_bytes)
+        if rejection is not None:
+            return None, rejection
+
+        # 先占位再检查，多个进程同时申请时不会一起越过上限
+        token = f"{kind}:{uuid.uuid4().hex}"
+        pipe = r.pipeline()
+        pipe.hset(COST_KEY, token, cost)
+        pipe.zadd(JOBS_KEY, {token: time.time() + LEASE + cost})
+        pipe.execute()
+
+        others = {t: c for t, c in cls._jobs().items() if t != token}
+        rejection = cls._check_queue(others, cost)
+        if rejection is not None:
+            cls.release(token)
+            return None, rejection
+        return token, None
+
+    @staticmethod
+    def release(token: str | None):
+        if not token:
+            return
+        pipe = r.pipeline()
+        pipe.zrem(JOBS_KEY, token)
+        pipe.hdel(COST_KEY, token)
+        pipe.execute()
+
+    @classmethod
+    def load(cls) -> dict:
+        """
+        当前负载与限制。
+        """
+        jobs = cls._jobs()
+        backlog = sum(jobs.values())
+        disk = shutil.disk_usage(BASE_DIR)
+        mem = cls.free_mem_mb()
+        by_kind = {}
+        for token in jobs:
+            kind = token.split(":", 1)[0]
+            by_kind[kind] = by_kind.get(kind, 0) + 1
+        return {
+            "enabled": ENABLED,
+            "queue_length": len(jobs),
+            "queue_by_kind": by_kind,
+            "backlog_seconds": backlog,
+            "estimated_wait": backlog / CAPACITY,
+            "capacity": CAPACITY,
+            "free_disk_gb": disk.free / 1024 ** 3,
+            "free_mem_mb": mem,
+            "accepting": not ENABLED or (len(jobs) < MAX_QUEUE
+                                         and disk.free >= MIN_FREE_DISK
+                                         and (mem is None or mem >= MIN_FREE_MEM_MB)
+                                         and (MAX_BACKLOG <= 0 or backlog < MAX_BACKLOG)),
+            "limits": {
+                "max_queue": MAX_QUEUE,
+                "max_backlog": MAX_BACKLOG,
+                "min_free_disk_gb": MIN_FREE_DISK / 1024 ** 3,
+                "min_free_mem_mb": MIN_FREE_MEM_MB,
+            },
+        }
@@ -0,0 +1,87 @@
+"""
+启动性能基准：测量各入口模块的导入耗时与导入后的常驻内存 (RSS)。
+
+每个入口都在全新的 Python 子进程中测量，互不影响。
+
+用法::
+
+    python bench_startup.py [--repeat 3]
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+BACKEND_DIR = Path(__file__).parent
+
+# 名称 -> 在子进程中执行的语句
+ENTRY_POINTS = {
+    "settings": "import settings",
+    "flaskApp": "import flaskApp",
+    "main": "import main",
+    "worker": "import worker",
+    "cp_run": "import cp_run",
+    "cp_train": "import cp_train",
+    "cp_run.warmup": "import cp_run; cp_run.Cprun.warmup()",
+    "train": "import train",
+}
+
+_PROBE = r"""
+import json, sys, time
+sys.path.insert(0, {backend!r})
+
+from procinfo import rss_mb
+
+base = rss_mb()
+t0 = time.perf_counter()
+{stmt}
+elapsed = time.perf_counter() - t0
+print(json.dumps({{"seconds": elapsed, "rss_mb": rss_mb(), "rss_delta_mb": rss_mb() - base}}))
+"""
+
+
+def measure(stmt: str) -> dict:
+    code = _PROBE.format(backend=str(BACKEND_DIR), stmt=stmt)
+    proc = subprocess.run([sys.executable, "-c", code], cwd=BACKEND_DIR,
+                          capture_output=True, text=True)
+    if proc.returncode != 0:
+        err = proc.stderr.strip().splitlines()
+        return {"error": err[-1] if err else f"exit code {proc.returncode}"}
+    return json.loads(proc.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=3, help="每个入口的测量次数，取中位数")
+    parser.add_argument("--json", action="store_true", help="以 JSON 输出结果")
+    args = parser.parse_args()
+
+    results = {}
+    for name, stmt in ENTRY_POINTS.items():
+        runs = [measure(stmt) for _ in range(max(1, args.repeat))]
+        ok = [x for x in runs if "error" not in x]
+        if not ok:
+            results[name] = runs[0]
+            continue
+        results[name] = {
+            "seconds": statistics.median(x["seconds"] for x in ok),
+            "rss_mb": statistics.median(x["rss_mb"] for x in ok),
+            "rss_delta_mb": statistics.median(x["rss_delta_mb"] for x in ok),
+        }
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"{'entry point':<16}{'import (s)':>12}{'RSS (MB)':>12}{'+RSS (MB)':>12}")
+    for name, res in results.items():
+        if "error" in res:
+            print(f"{name:<16}  error: {res['error']}")
+        else:
+            print(f"{name:<16}{res['seconds']:>12.3f}{res['rss_mb']:>12.1f}{res['rss_delta_mb']:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,27 +1,47 @@
 import os
+import shutil
 from PIL import Image
 import numpy as np
+import base64
 import datetime
+import hashlib
+import io
+import json
+import tempfile
+import threading
 import time
-from omegaconf import OmegaConf
-from pathlib import Path
-
-CONFIG_PATH = Path(__file__).parent / "config.yaml"
-cfg = OmegaConf.load(CONFIG_PATH)
-cfg.data.root_dir = str((CONFIG_PATH.parent / cfg.data.root_dir).resolve())
-BASE_DIR = cfg.data.root_dir
-UPLOAD_DIR = cfg.data.upload_dir
-OUTPUT_DIR = cfg.data.run.output_dir
-OUTPUT_TEST_DIR = cfg.data.run.test_output_dir
-MODELS_DIR = str((CONFIG_PATH.parent / cfg.model.save_dir).resolve())
-os.makedirs(MODELS_DIR, exist_ok=True)
-os.environ["CELLPOSE_LOCAL_MODELS_PATH"] = MODELS_DIR
-
-from cellpose import models, plot
-from cellpose.io import imread, save_masks
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from settings import cfg, r, OUTPUT_DIR, OUTPUT_TEST_DIR, CACHE_DIR, FLOWS_DIR
+
+AUTO_DIAMETER = cfg.get("segment", {}).get("auto_diameter", {})
+AUTO_DIAMETER_MAX_SIDE = int(AUTO_DIAMETER.get("max_side", 512))
+AUTO_DIAMETER_TTL = int(AUTO_DIAMETER.get("cache_ttl", 604800))
+QUICKLOOK_MAX_SIDE = int(cfg.get("segment", {}).get("quicklook", {}).get("max_side", 512))
+SAVE_FLOWS = bool(cfg.get("segment", {}).get("save_flows", True))
+MODEL_CACHE_SIZE = int(cfg.get("segment", {}).get("model_cache_size", 2))
+QUICKLOOK_DIR = os.path.join(CACHE_DIR, "quicklook")
+STACK = cfg.get("segment", {}).get("stack", {})
+
+# cellpose / torch 体积较大，在方法内部按需导入，避免拖慢 web 进程启动
 
 class Cprun:
 
+    # 进程内常驻的模型，key 为模型名，value 为 (模型, 推理锁)
+    _models = OrderedDict()
+    _models_lock = threading.Lock()
+
+    @classmethod
+    def warmup(cls):
+        """
+        预先导入 cellpose 及其依赖，使首个任务无需等待导入。
+
+        :return:
+        """
+        from cellpose import models, plot
+        from cellpose.io import imread, save_masks
+
     @classmethod
     def run_test(cls):
         """
@@ -29,6 +49,9 @@ class Cprun:
 
         :return:
         """
+        from cellpose import models, plot
+        from cellpose.io import imread, save_masks
+
         model = models.CellposeModel(gpu=True)
         files = ['test_tif/img.png']
         imgs = [imread(f) for f in files]
@@ -61,7 +84,8 @@ class Cprun:
                   model: str = "cpsam",
                   diameter: float | None = None,
                   flow_threshold: float = 0.4,
-                  cellprob_threshold: float = 0.0, ):
+                  cellprob_threshold: float = 0.0,
+                  auto_diameter: bool = False, ):
 
         if time is None:
             return [False, "No time received"]
@@ -69,11 +93,22 @@ class Cprun:
         if images is None:
             return [False, "No images received"]
 
+        from cellpose import models
+        from cellpose.io import imread
+
         message = [f"Using {model} model"]
+        info = {}
 
+        model_name = model
         model = models.CellposeModel(gpu=True, model_type=model)
         files = images
         imgs = [imread(f) for f in files]
+        if diameter is None and auto_diameter and imgs:
+            info["diameter_estimate"] = cls.estimate_diameter(model, model_name, imgs[0],
+                                                              flow_threshold=flow_threshold,
+                                                              cellprob_threshold=cellprob_threshold)
+            diameter = info["diameter_estimate"]["diameter"]
+            message.append(f"Estimated diameter: {diameter}")
         masks, flows, styles = model.eval(
             imgs,
             flow_threshold=flow_threshold,
@@ -85,16 +120,554 @@ class Cprun:
         outdir = os.path.join(OUTPUT_DIR, ts)
         os.makedirs(outdir, exist_ok=True)  # 自动创建目录
         for img, mask, flow, name in zip(imgs, masks, flows, files):
-            base = os.path.join(outdir, os.path.splitext(os.path.basename(name))[0])
-            # 使用内置绘图生成蒙版
-            out = base + "_output"
-            save_masks(imgs, mask, flow, out, tif=True)
+            stem = os.path.splitext(os.path.basename(name))[0]
+            cls._save_outputs(img, mask, flow, os.path.join(outdir, stem))
+            cls._save_task_flows(ts, stem, flow, name, diameter=diameter)
 
-            # 用 plot 生成彩色叠加图（不依赖 skimage）
-            rgb = plot.image_to_rgb(img, channels=[0, 0])  # 原图转 RGB
-            over = plot.mask_overlay(rgb, masks=mask, colors=None)  # 叠加彩色实例
-            Image.fromarray(over).save(base + "_overlay.png")
+        message.append(f"Output saved to: {outdir}")
+        message.append(outdir)
+        return [True, message, info]
+
+    @classmethod
+    def get_model(cls, model: str):
+        """
+        复用进程内已加载的模型，交互式预览无需每次重新加载权重。
+
+        :return: (模型, 推理锁)
+        """
+        from cellpose import models
+
+        with cls._models_lock:
+            if model in cls._models:
+                cls._models.move_to_end(model)
+                return cls._models[model]
+            entry = (models.CellposeModel(gpu=True, model_type=model), threading.Lock())
+            cls._models[model] = entry
+            while len(cls._models) > max(1, MODEL_CACHE_SIZE):
+                cls._models.popitem(last=False)
+            return entry
+
+    @staticmethod
+    def _channels_last(img):
+        if img.ndim == 3 and img.shape[0] < min(img.shape[1:]):
+            img = np.moveaxis(img, 0, -1)  # 通道放到最后
+        return img
+
+    @classmethod
+    def _downsample(cls, img, max_side: int):
+        """
+        将图片等比缩小到最长边不超过 max_side，返回 (缩小后的图片, 缩放比例)。
+        """
+        from cellpose.transforms import resize_image
+
+        img = cls._channels_last(img)
+        Ly, Lx = img.shape[:2]
+        scale = min(1.0, max_side / max(Ly, Lx))
+        if scale >= 1.0:
+            return img, 1.0
+        Ly_s, Lx_s = max(1, int(round(Ly * scale))), max(1, int(round(Lx * scale)))
+        small = resize_image(img, Ly=Ly_s, Lx=Lx_s, no_channels=img.ndim == 2)
+        return small, Ly_s / Ly
+
+    @classmethod
+    def estimate_diameter(cls, cp_model, model_name: str, img,
+                          flow_threshold: float = 0.4,
+                          cellprob_threshold: float = 0.0) -> dict:
+        """
+        在缩小后的图片上分割一次，以掩膜的中位直径作为整批图片的 diameter。
+
+        结果按 (模型, 图片尺寸/数据类型) 缓存，同一台显微镜、同一放大倍数的后续任务直接复用。
+
+        :return: {"diameter", "cached", "estimate_seconds", "time_saved"}
+        """
+        from cellpose import utils
+
+        fingerprint = json.dumps([model_name, list(img.shape), str(img.dtype)])
+        key = "diam:" + hashlib.sha1(fingerprint.encode()).hexdigest()
+        raw = r.get(key)
+        if raw:
+            cached = json.loads(raw)
+            return {"diameter": cached["diameter"], "cached": True,
+                    "estimate_seconds": 0.0, "time_saved": cached["estimate_seconds"]}
+
+        t0 = time.time()
+        small, scale = cls._downsample(img, AUTO_DIAMETER_MAX_SIDE)
+        masks, _, _ = cp_model.eval(small, flow_threshold=flow_threshold,
+                                    cellprob_threshold=cellprob_threshold)
+        md, _ = utils.diameters(masks)
+        elapsed = time.time() - t0
+        # 未检测到细胞时不缓存，交给 cellpose 默认处理
+        diameter = float(md / scale) if md > 0 else None
+        if diameter is not None:
+            r.set(key, json.dumps({"diameter": diameter, "estimate_seconds": elapsed}), ex=AUTO_DIAMETER_TTL)
+        return {"diameter": diameter, "cached": False, "estimate_seconds": elapsed, "time_saved": 0.0}
+
+    @staticmethod
+    def save_flows(path: str, dP, cellprob, **meta):
+        """
+        以 float16 压缩保存网络输出（flows 与 cellprob），用于之后仅重新计算掩膜。
+        """
+        np.savez_compressed(path,
+                            dP=np.asarray(dP, dtype=np.float16),
+                            cellprob=np.asarray(cellprob, dtype=np.float16),
+                            **{k: np.asarray(v) for k, v in meta.items()})
+
+    @staticmethod
+    def load_flows(path: str) -> dict:
+        with np.load(path, allow_pickle=False) as f:
+            return {k: f[k] for k in f.files}
+
+    @staticmethod
+    def niter_for(diameter: float | None) -> int:
+        """
+        CellposeModel.eval 计算掩膜时使用的迭代次数：指定 diameter 时按 200 * diameter / 30 缩放。
+        """
+        return int(200 * diameter / 30) if diameter else 200
+
+    @staticmethod
+    def masks_from_flows(dP, cellprob, flow_threshold: float = 0.4,
+                         cellprob_threshold: float = 0.0, niter: int = 200, device=None):
+        """
+        由网络输出重建掩膜，不经过网络前向，仅 flow_threshold / cellprob_threshold 生效。
+
+        :param niter: 须与生成该网络输出时 eval 使用的值一致（见 niter_for），否则大细胞会被切碎
+        """
+        import torch
+        from cellpose import dynamics
+
+        out = dynamics.resize_and_compute_masks(
+            np.asarray(dP, dtype=np.float32), np.asarray(cellprob, dtype=np.float32),
+            niter=int(niter), cellprob_threshold=cellprob_threshold, flow_threshold=flow_threshold,
+            device=device if device is not None else torch.device("cpu"))
+        return out[0] if isinstance(out, tuple) else out
+
+    @staticmethod
+    def overlay_png(img, masks) -> bytes:
+        from cellpose import plot
+
+        rgb = plot.image_to_rgb(img, channels=[0, 0])
+        over = plot.mask_overlay(rgb, masks=masks, colors=None)
+        buf = io.BytesIO()
+        Image.fromarray(over).save(buf, format="PNG")
+        return buf.getvalue()
+
+    @classmethod
+    def quicklook(cls,
+                  data: bytes | None = None,
+                  filename: str = "image.tif",
+                  cache_key: str | None = None,
+                  model: str = "cpsam",
+                  diameter: float | None = None,
+                  flow_threshold: float = 0.4,
+                  cellprob_threshold: float = 0.0,
+                  max_side: int = QUICKLOOK_MAX_SIDE,
+                  crop: tuple[int, int, int, int] | None = None) -> dict:
+        """
+        快速预览：在缩小后的图片（或裁剪区域）上分割并直接返回叠加图。
+
+        网络输出按 (图片内容, 模型, diameter, 缩放, 裁剪) 缓存，之后只改阈值时传入 cache_key
+        即可跳过网络前向，仅重建掩膜。
+
+        :param data: 原始图片文件内容，传入 cache_key 且缓存仍在时可省略
+        :param crop: 在原图上的裁剪区域 (x, y, w, h)
+        :return:
+        """
+        from cellpose.io import imread
+
+        t0 = time.time()
+        if cache_key is None:
+            if data is None:
+                raise ValueError("no image received")
+            h = hashlib.sha1(data)
+            h.update(json.dumps([model, diameter, max_side, crop]).encode())
+            cache_key = h.hexdigest()
+
+        os.makedirs(QUICKLOOK_DIR, exist_ok=True)
+        path = os.path.join(QUICKLOOK_DIR, cache_key + ".npz")
+        cached = os.path.exists(path)
+        if cached:
+            saved = cls.load_flows(path)
+            img, dP, cellprob = saved["image"], saved["dP"], saved["cellprob"]
+            niter = int(saved["niter"]) if "niter" in saved else cls.niter_for(None)
+            # 用于 LRU 清理
+            os.utime(path)
+        else:
+            if data is None:
+                raise FileNotFoundError("quicklook cache expired, upload the image again")
+            suffix = os.path.splitext(filename)[1] or ".tif"
+            with tempfile.NamedTemporaryFile(suffix=suffix) as tmp:
+                tmp.write(data)
+                tmp.flush()
+                img = cls._channels_last(imread(tmp.name))
+            if crop is not None:
+                x, y, w, h = crop
+                img = img[y:y + h, x:x + w]
+                if img.size == 0:
+                    raise ValueError("crop is outside the image")
+            img, scale = cls._downsample(img, max_side)
+            cp_model, lock = cls.get_model(model)
+            small_diameter = diameter * scale if diameter else None
+            with lock:
+                _, flows, _ = cp_model.eval(img, diameter=small_diameter, compute_masks=False)
+            dP, cellprob = flows[1], flows[2]
+            # 与 eval 在同一张缩小图上计算掩膜时的迭代次数一致
+            niter = cls.niter_for(small_diameter)
+            cls.save_flows(path, dP, cellprob, image=img, niter=niter)
+
+        masks = cls.masks_from_flows(dP, cellprob, flow_threshold=flow_threshold,
+                                     cellprob_threshold=cellprob_threshold, niter=niter)
+        return {
+            "cache_key": cache_key,
+            "cached": cached,
+            "shape": list(masks.shape),
+            "n_masks": int(masks.max()),
+            "seconds": time.time() - t0,
+            "image": base64.b64encode(cls.overlay_png(img, masks)).decode("utf-8"),
+        }
+
+    @classmethod
+    def _save_task_flows(cls, ts: str, stem: str, flow, image_path: str, diameter: float | None = None):
+        """
+        保存任务中一张图片的网络输出，供 resegment 使用。
+
+        :param diameter: 分割时使用的 diameter，决定重建掩膜的迭代次数
+        """
+        if not SAVE_FLOWS:
+            return
+        flowdir = os.path.join(FLOWS_DIR, ts)
+        os.makedirs(flowdir, exist_ok=True)
+        cls.save_flows(os.path.join(flowdir, stem + ".npz"), flow[1], flow[2],
+                       image_path=os.path.abspath(image_path), niter=cls.niter_for(diameter))
+
+    @classmethod
+    async def resegment(cls,
+                        source: str | None = None,
+                        time: str | None = None,
+                        flow_threshold: float = 0.4,
+                        cellprob_threshold: float = 0.0, ):
+        """
+        使用已保存的网络输出，以新的阈值重新计算掩膜与叠加图，不再运行网络。
+
+        :param source: 原任务 ID
+        :param time: 新任务 ID，结果写入 OUTPUT_DIR/<time>
+        :return:
+        """
+        if time is None:
+            return [False, "No time received"]
+
+        from cellpose.io import imread
+
+        srcdir = os.path.join(FLOWS_DIR, source)
+        names = sorted(n for n in os.listdir(srcdir) if n.endswith(".npz")) if os.path.isdir(srcdir) else []
+        if not names:
+            return [False, f"No saved flows for task {source}"]
+
+        outdir = os.path.join(OUTPUT_DIR, time)
+        flowdir = os.path.join(FLOWS_DIR, time)
+        os.makedirs(outdir, exist_ok=True)
+        os.makedirs(flowdir, exist_ok=True)
+        message = [f"Re-segmenting {len(names)} images from {source}"]
+        for name in names:
+            saved = cls.load_flows(os.path.join(srcdir, name))
+            image_path = str(saved["image_path"])
+            if not os.path.exists(image_path):
+                raise FileNotFoundError(f"source image no longer available: {os.path.basename(image_path)}")
+            img = imread(image_path)
+            dP, cellprob = saved["dP"], saved["cellprob"]
+            # 旧任务未保存 niter，按 eval 未指定 diameter 时的默认值处理
+            niter = int(saved["niter"]) if "niter" in saved else 200
+            masks = cls.masks_from_flows(dP, cellprob, flow_threshold=flow_threshold,
+                                         cellprob_threshold=cellprob_threshold, niter=niter)
+            stem = os.path.splitext(name)[0]
+            cls._save_outputs(img, masks, [None, dP, cellprob], os.path.join(outdir, stem))
+            # 新任务同样可以再次 resegment，硬链接避免复制
+            try:
+                os.link(os.path.join(srcdir, name), os.path.join(flowdir, name))
+            except OSError:
+                shutil.copy(os.path.join(srcdir, name), os.path.join(flowdir, name))
 
         message.append(f"Output saved to: {outdir}")
         message.append(outdir)
-        return [True, message]
+        return [True, message, {"source": source}]
+
+    @classmethod
+    def _save_outputs(cls, img, mask, flow, base: str):
+        """
+        保存单张图片的蒙版与彩色叠加图。
+
+        :param base: 输出文件路径前缀（不含后缀）
+        :return:
+        """
+        from cellpose import plot
+        from cellpose.io import save_masks
+
+        # 使用内置绘图生成蒙版
+        out = base + "_output"
+        save_masks(img, mask, flow, out, tif=True)
+
+        # 用 plot 生成彩色叠加图（不依赖 skimage）
+        rgb = plot.image_to_rgb(img, channels=[0, 0])  # 原图转 RGB
+        over = plot.mask_overlay(rgb, masks=mask, colors=None)  # 叠加彩色实例
+        Image.fromarray(over).save(base + "_overlay.png")
+
+    @classmethod
+    async def run_batch(cls,
+                        images: list[str] | None = None,
+                        root: str | None = None,
+                        time: str | None = None,
+                        model: str = "cpsam",
+                        diameter: float | None = None,
+                        flow_threshold: float = 0.4,
+                        cellprob_threshold: float = 0.0,
+                        chunk_size: int = 8,
+                        auto_diameter: bool = False,
+                        progress=None, ):
+        """
+        对服务器本地的大量图片分块分割，不复制输入文件。
+
+        每完成一张图片即写出结果并记入检查点文件，任务重启后会跳过已完成的图片。
+
+        :param images: 待分割的图片路径
+        :param root: 输入根目录，输出文件名按相对于该目录的路径生成，避免重名
+        :param chunk_size: 每次送入 model.eval 的图片数
+        :param auto_diameter: 未指定 diameter 时在第一张图片上估计一次并用于整批
+        :param progress: 回调 progress(name, ok, error)，每处理完一张图片调用一次
+        :return:
+        """
+        if time is None:
+            return [False, "No time received"]
+
+        if not images:
+            return [False, "No images received"]
+
+        from cellpose import models
+        from cellpose.io import imread
+
+        outdir = os.path.join(OUTPUT_DIR, time)
+        os.makedirs(outdir, exist_ok=True)
+        checkpoint = os.path.join(outdir, ".done")
+        done = set()
+        if os.path.exists(checkpoint):
+            with open(checkpoint, encoding="utf-8") as f:
+                done = {line.rstrip("\n") for line in f if line.strip()}
+
+        def rel_name(path):
+            rel = os.path.relpath(path, root) if root else os.path.basename(path)
+            return rel.replace(os.sep, "/")
+
+        todo = [f for f in images if rel_name(f) not in done]
+        message = [f"Using {model} model", f"{len(done)} images already done, {len(todo)} remaining"]
+
+        cp_model = models.CellposeModel(gpu=True, model_type=model)
+        info = {}
+        n_failed = 0
+        with open(checkpoint, "a", encoding="utf-8") as ckpt:
+            for i in range(0, len(todo), max(1, chunk_size)):
+                chunk, imgs = [], []
+                for f in todo[i:i + chunk_size]:
+                    try:
+                        imgs.append(imread(f))
+                        chunk.append(f)
+                    except Exception as e:
+                        n_failed += 1
+                        if progress:
+                            progress(rel_name(f), False, str(e))
+
+                if not chunk:
+                    continue
+
+                if diameter is None and auto_diameter:
+                    info["diameter_estimate"] = cls.estimate_diameter(cp_model, model, imgs[0],
+                                                                      flow_threshold=flow_threshold,
+                                                                      cellprob_threshold=cellprob_threshold)
+                    diameter = info["diameter_estimate"]["diameter"]
+                    auto_diameter = False
+                    message.append(f"Estimated diameter: {diameter}")
+
+                try:
+                    masks, flows, styles = cp_model.eval(
+                        imgs,
+                        flow_threshold=flow_threshold,
+                        cellprob_threshold=cellprob_threshold,
+                        diameter=diameter
+                    )
+                except Exception as e:
+                    n_failed += len(chunk)
+                    if progress:
+                        for f in chunk:
+                            progress(rel_name(f), False, str(e))
+                    continue
+
+                for img, mask, flow, f in zip(imgs, masks, flows, chunk):
+                    name = rel_name(f)
+                    try:
+                        stem = os.path.splitext(name)[0].replace("/", "__")
+                        cls._save_outputs(img, mask, flow, os.path.join(outdir, stem))
+                        cls._save_task_flows(time, stem, flow, f, diameter=diameter)
+                    except Exception as e:
+                        n_failed += 1
+                        if progress:
+                            progress(name, False, str(e))
+                        continue
+                    ckpt.write(name + "\n")
+                    ckpt.flush()
+                    if progress:
+                        progress(name, True, None)
+
+        message.append(f"{n_failed} images failed")
+        message.append(f"Output saved to: {outdir}")
+        message.append(outdir)
+        return [True, message, info]
+
+    @staticmethod
+    def _match_labels(prev, cur_ref, cur_all, threshold: float, next_id: int):
+        """
+        按 IoU 将当前平面（或块）的标签对应到上一平面的标签，用于 z 方向拼接或逐帧跟踪。
+
+        :param prev: 上一平面已重新编号的标签，None 表示没有上一平面
+        :param cur_ref: 当前用于匹配的平面（逐平面模式即当前平面，3D 块即块的第一层）
+        :param cur_all: 需要重新编号的全部标签（平面或整个 3D 块）
+        :param next_id: 下一个可用的新标签
+        :return: (重新编号后的 cur_all, 新的 next_id)
+        """
+        cur_all = np.asarray(cur_all)
+        n_cur = int(cur_all.max())
+        if n_cur == 0:
+            return np.zeros(cur_all.shape, dtype=np.uint32), next_id
+        mapping = np.zeros(n_cur + 1, dtype=np.uint32)
+        area_all = np.bincount(cur_all.ravel(), minlength=n_cur + 1)
+
+        if prev is not None and prev.max() > 0 and threshold < 1:
+            fg = (prev > 0) & (cur_ref > 0)
+            pairs = prev[fg].astype(np.int64) * (n_cur + 1) + cur_ref[fg].astype(np.int64)
+            pairs, inter = np.unique(pairs, return_counts=True)
+            p_lbl, c_lbl = pairs // (n_cur + 1), pairs % (n_cur + 1)
+            area_prev = np.bincount(prev.ravel())
+            area_cur = np.bincount(cur_ref.ravel(), minlength=n_cur + 1)
+            iou = inter / (area_prev[p_lbl] + area_cur[c_lbl] - inter)
+            used = set()
+            # IoU 从大到小贪心匹配，每个标签最多匹配一次
+            for k in np.argsort(-iou):
+                if iou[k] < threshold:
+                    break
+                if mapping[c_lbl[k]] or p_lbl[k] in used:
+                    continue
+                mapping[c_lbl[k]] = p_lbl[k]
+                used.add(p_lbl[k])
+
+        for lbl in np.nonzero(area_all)[0]:
+            if lbl and not mapping[lbl]:
+                mapping[lbl] = next_id
+                next_id += 1
+        return mapping[cur_all], next_id
+
+    @classmethod
+    async def run_stack(cls,
+                        path: str | None = None,
+                        time: str | None = None,
+                        model: str = "cpsam",
+                        mode: str = "z",
+                        do_3D: bool = False,
+                        diameter: float | None = None,
+                        flow_threshold: float = 0.4,
+                        cellprob_threshold: float = 0.0,
+                        stitch_threshold: float = float(STACK.get("stitch_threshold", 0.25)),
+                        chunk_size: int = int(STACK.get("chunk_size", 8)),
+                        workers: int = int(STACK.get("workers", 2)),
+                        progress=None, ):
+        """
+        分割多页 TIFF（z-stack 或时间序列），按块流式读取，内存占用与总页数无关。
+
+        各块由线程池并行推理（每个线程一个模型），再按顺序把标签沿 z 方向拼接（mode="z"）
+        或逐帧跟踪（mode="t"），结果逐页写入分块（tile）压缩的标签 TIFF。
+
+        :param path: 多页 TIFF 路径，每一页是一个平面 / 一帧
+        :param mode: "z" 为 z-stack，"t" 为时间序列
+        :param do_3D: 仅 mode="z" 时有效，对每个块做 3D 推理，块之间再拼接
+        :param stitch_threshold: 相邻平面标签视为同一对象所需的 IoU
+        :param chunk_size: 每块的平面数
+        :param workers: 并行推理的线程数
+        :param progress: 回调 progress(done, total)，每完成一块调用一次
+        :return:
+        """
+        if time is None:
+            return [False, "No time received"]
+
+        if path is None:
+            return [False, "No images received"]
+
+        import tifffile
+        from cellpose import models
+
+        with tifffile.TiffFile(path) as tf:
+            n_planes = len(tf.pages)
+        chunk_size = max(1, chunk_size)
+        do_3D = do_3D and mode == "z"
+        message = [f"Using {model} model", f"{n_planes} planes, mode={mode}, do_3D={do_3D}"]
+
+        local = threading.local()
+
+        def segment_chunk(start):
+            # TiffFile 不是线程安全的，每块单独打开，只读取本块的页
+            with tifffile.TiffFile(path) as tf:
+                planes = [tf.pages[i].asarray() for i in range(start, min(start + chunk_size, n_planes))]
+            if not hasattr(local, "model"):
+                local.model = models.CellposeModel(gpu=True, model_type=model)
+            kwargs = dict(diameter=diameter, flow_threshold=flow_threshold,
+                          cellprob_threshold=cellprob_threshold)
+            if do_3D:
+                masks, _, _ = local.model.eval(np.stack(planes), do_3D=True, z_axis=0, **kwargs)
+                masks = list(masks)
+            else:
+                masks, _, _ = local.model.eval(planes, **kwargs)
+            return start, planes, masks
+
+        outdir = os.path.join(OUTPUT_DIR, time)
+        os.makedirs(outdir, exist_ok=True)
+        stem = os.path.splitext(os.path.basename(path))[0]
+        out_path = os.path.join(outdir, stem + "_masks.tif")
+        preview_index = n_planes // 2
+
+        prev, next_id, done = None, 1, 0
+        starts = list(range(0, n_planes, chunk_size))
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool, \
+                tifffile.TiffWriter(out_path, bigtiff=True) as tw:
+            pending = []
+            # 最多同时处理 workers 个块，限制内存中的平面数
+            for start in starts[:max(1, workers)]:
+                pending.append(pool.submit(segment_chunk, start))
+            submitted = len(pending)
+            while pending:
+                start, planes, masks = pending.pop(0).result()
+                if submitted < len(starts):
+                    pending.append(pool.submit(segment_chunk, starts[submitted]))
+                    submitted += 1
+
+                if do_3D:
+                    # 3D 块内部的标签已一致，只需用块的第一层与上一块的最后一层匹配
+                    block, next_id = cls._match_labels(prev, masks[0], np.stack(masks),
+                                                       stitch_threshold, next_id)
+                    labeled = list(block)
+                else:
+                    labeled = []
+                    for m in masks:
+                        m, next_id = cls._match_labels(prev, m, m, stitch_threshold, next_id)
+                        labeled.append(m)
+                        prev = m
+
+                for i, (img, lbl) in enumerate(zip(planes, labeled)):
+                    tile = (256, 256) if min(lbl.shape[:2]) >= 256 else None
+                    tw.write(lbl.astype(np.uint32), tile=tile, compression="zlib", metadata=None)
+                    if start + i == preview_index:
+                        # 中间一层的叠加图，供 /preview 查看
+                        with open(os.path.join(outdir, f"{stem}_{mode}{preview_index:04d}_overlay.png"), "wb") as fp:
+                            fp.write(cls.overlay_png(cls._channels_last(img), lbl))
+
+                prev = labeled[-1]
+                done += len(planes)
+                if progress:
+                    progress(done, n_planes)
+
+        message.append(f"Output saved to: {out_path}")
+        message.append(outdir)
+        return [True, message, {"planes": n_planes, "objects": next_id - 1, "mode": mode}]
@@ -1,36 +1,59 @@
 import os.path
+import socket
 from pathlib import Path
-from omegaconf import OmegaConf
-import redis
 import datetime
 import json
 
-from sympy import false
-
-CONFIG_PATH = Path(__file__).parent / "config.yaml"
-cfg = OmegaConf.load(CONFIG_PATH)
-cfg.data.root_dir = str((CONFIG_PATH.parent / cfg.data.root_dir).resolve())
-BASE_DIR = cfg.data.root_dir
-TRAIN_DIR = cfg.data.train.train_dir
-TEST_DIR = cfg.data.train.test_dir
-MODELS_DIR = str((CONFIG_PATH.parent / cfg.model.save_dir).resolve())
-os.environ["CELLPOSE_LOCAL_MODELS_PATH"] = MODELS_DIR
-
-r = redis.Redis(host="127.0.0.1", port=6379, db=0)
-
-def set_status(task_id, status, train_losses, test_losses, **extra):
-    payload = {"status": status,
-               "updated_at": datetime.datetime.utcnow().isoformat(),
-               "train_losses": train_losses.tolist() if hasattr(train_losses, "tolist") else train_losses,
-               "test_losses": test_losses.tolist() if hasattr(test_losses, "tolist") else test_losses,
-               **extra}
+from metrics import TrainMetrics
+from model_registry import ModelRegistry
+from settings import r, BASE_DIR, TRAIN_DIR, TEST_DIR
+
+def set_status(task_id, status, **extra):
+    payload = {"status": status, "updated_at": datetime.datetime.utcnow().isoformat(), **extra}
     r.set(f"task:{task_id}", json.dumps(payload), ex=86400)  # 1 天过期
 
 def get_status(task_id):
     raw = r.get(f"task:{task_id}")
     return json.loads(raw) if raw else None
 
-from cellpose import io, models, train
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def _ddp_worker(rank, world_size, port, base_model, train_kwargs, result_path):
+    """
+    数据并行训练的单个进程（由 torch.multiprocessing.spawn 启动）。
+
+    每个 rank 各自加载模型，通过 gloo 在 CPU 上同步梯度，训练结果只由 rank 0 写入 result_path（JSON）。
+    """
+    import torch
+    import torch.distributed as dist
+    from cellpose import io, models
+    import train
+
+    # 各 rank 平分 CPU 核心，避免线程数超额订阅
+    torch.set_num_threads(max(1, (os.cpu_count() or 1) // world_size))
+    dist.init_process_group("gloo", init_method=f"tcp://127.0.0.1:{port}",
+                            rank=rank, world_size=world_size)
+    try:
+        if rank == 0:
+            io.logger_setup()
+        model = models.CellposeModel(gpu=False, pretrained_model=base_model)
+        out = train.train_seg(model.net, rank=rank, world_size=world_size, **train_kwargs)
+        if rank == 0:
+            model_path, train_losses, test_losses, history = out
+            # 结果写入文件而不是经管道回传：结果超过管道缓冲区时，put 会阻塞到父进程读取，
+            # 而父进程在 join 中等待子进程退出，两边互相等待
+            result = {"model_path": str(model_path),
+                      "train_losses": train_losses.tolist(), "test_losses": test_losses.tolist(),
+                      "history": {k: v.tolist() if hasattr(v, "tolist") else v for k, v in history.items()}}
+            tmp = f"{result_path}.tmp"
+            with open(tmp, "w") as f:
+                json.dump(result, f)
+            os.replace(tmp, result_path)
+    finally:
+        dist.destroy_process_group()
 
 class Cptrain:
 
@@ -54,7 +77,36 @@ class Cptrain:
                           rescale: bool= False,
                           scale_range=None,
                           channel_axis: int = None,
+                          bf16: bool = False,
+                          grad_accum_steps: int = 1,
+                          activation_checkpointing: bool = False,
+                          n_ranks: int = 1,
+                          lr_schedule: str = "default",
+                          early_stopping_patience: int = 0,
+                          min_delta: float = 0.,
+                          restore_best: bool = True,
+                          test_every: int = 10,
                           ):
+        """
+        训练分割模型。
+
+        :param bf16: 前向使用 bfloat16 autocast（CPU 上可明显降低内存）
+        :param grad_accum_steps: 每个 batch 拆成的 micro-batch 数，梯度累积后再更新参数
+        :param activation_checkpointing: 反向传播时重新计算 transformer block 的激活，以计算换内存
+        :param n_ranks: 数据并行的进程数，大于 1 时在本机启动多个进程（gloo，CPU）训练，
+                        batch_size 为每个进程的大小
+        :param lr_schedule: 学习率策略，default（预热后分段减半）/ cosine / plateau（测试损失停滞时减半）
+        :param early_stopping_patience: 测试损失连续多少个 epoch 没有改善时提前停止，0 表示不启用
+        :param min_delta: 视为改善所需的最小下降量
+        :param restore_best: 提前停止时保存测试损失最低的 epoch 的权重
+        :param test_every: 每隔多少个 epoch 计算一次测试损失
+        :return: (train_losses, test_losses, history)，history 含每个 epoch 的 step_time、peak_mem_mb、lr，
+                 以及 best_epoch、best_test_loss、stopped_epoch、stop_reason；逐 epoch 的指标在训练过程中
+                 写入 TrainMetrics，任务状态中只保存摘要
+        """
+        # cellpose / torch 体积较大，仅在训练任务中导入；train 为本项目修改过的训练循环
+        from cellpose import io, models
+        import train
 
         train_dir = Path(TRAIN_DIR) / time
         test_dir = Path(TEST_DIR) / time
@@ -65,21 +117,59 @@ class Cptrain:
                                          mask_filter=mask_filter, look_one_level_down=False)
         images, labels, image_names, test_images, test_labels, image_names_test = output
 
-        model = models.CellposeModel(gpu=True, pretrained_model=base_model)
+        train_kwargs = dict(
+            train_data=images, train_labels=labels,
+            test_data=test_images, test_labels=test_labels,
+            train_probs=train_probs, test_probs=test_probs,
+            weight_decay=weight_decay, learning_rate=learning_rate,
+            n_epochs=n_epochs, model_name=model_name,
+            save_path=BASE_DIR, batch_size=batch_size,
+            normalize=normalize, compute_flows=compute_flows, min_train_masks=min_train_masks,
+            nimg_per_epoch=nimg_per_epoch, rescale=rescale, scale_range=scale_range, channel_axis=channel_axis,
+            ts=time, bf16=bf16, grad_accum_steps=grad_accum_steps,
+            activation_checkpointing=activation_checkpointing,
+            lr_schedule=lr_schedule, early_stopping_patience=early_stopping_patience,
+            min_delta=min_delta, restore_best=restore_best, test_every=max(1, int(test_every)),
+        )
+
+        TrainMetrics.clear(time)
+        set_status(time, "running", n_epochs=n_epochs)
 
-        set_status(time, "running", None, None)
+        n_ranks = max(1, int(n_ranks))
+        if n_ranks > 1:
+            import torch.multiprocessing as mp
+            result_path = train_dir / ".ddp_result.json"
+            result_path.unlink(missing_ok=True)
+            # 任一 rank 异常时 spawn 抛出 ProcessRaisedException，不会读取结果
+            mp.spawn(_ddp_worker, args=(n_ranks, _free_port(), base_model, train_kwargs, str(result_path)),
+                     nprocs=n_ranks, join=True)
+            with open(result_path) as f:
+                result = json.load(f)
+            result_path.unlink()
+            model_path, train_losses, test_losses, history = (
+                result["model_path"], result["train_losses"], result["test_losses"], result["history"])
+        else:
+            model = models.CellposeModel(gpu=True, pretrained_model=base_model)
+            model_path, train_losses, test_losses, history = train.train_seg(model.net, **train_kwargs)
+        history = {k: v.tolist() if hasattr(v, "tolist") else v for k, v in history.items()}
 
-        model_path, train_losses, test_losses = train.train_seg(model.net,
-                                                                train_data=images, train_labels=labels,
-                                                                test_data=test_images, test_labels=test_labels,
-                                                                train_probs=train_probs, test_probs=test_probs,
-                                                                weight_decay=weight_decay, learning_rate=learning_rate,
-                                                                n_epochs=n_epochs, model_name=model_name,
-                                                                save_path=BASE_DIR, batch_size=batch_size,
-                                                                normalize=normalize, compute_flows=compute_flows, min_train_masks=min_train_masks,
-                                                                nimg_per_epoch=nimg_per_epoch, rescale=rescale, scale_range=scale_range, channel_axis=channel_axis
-                                                                )
+        ModelRegistry.register(model_path, base_model=base_model,
+                               train_losses=train_losses, test_losses=test_losses,
+                               params={"batch_size": batch_size, "learning_rate": learning_rate,
+                                       "n_epochs": n_epochs, "weight_decay": weight_decay,
+                                       "normalize": normalize, "compute_flows": compute_flows,
+                                       "min_train_masks": min_train_masks, "nimg_per_epoch": nimg_per_epoch,
+                                       "rescale": rescale, "scale_range": scale_range,
+                                       "bf16": bf16, "grad_accum_steps": grad_accum_steps,
+                                       "activation_checkpointing": activation_checkpointing,
+                                       "n_ranks": n_ranks, "lr_schedule": lr_schedule,
+                                       "early_stopping_patience": early_stopping_patience,
+                                       "min_delta": min_delta, "restore_best": restore_best,
+                                       "best_epoch": history["best_epoch"],
+                                       "stopped_epoch": history["stopped_epoch"],
+                                       "n_train": len(images), "n_test": len(test_images) if test_images else 0,
+                                       "task_id": time})
 
-        set_status(time, "done", train_losses, test_losses)
+        set_status(time, "done", **TrainMetrics.summary(train_losses, test_losses, history))
         print("模型已保存到:", model_path)
-        return train_losses, test_losses
+        return train_losses, test_losses, history
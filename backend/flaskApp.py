@@ -1,61 +1,119 @@
-import asyncio
 import base64
 import datetime
+import glob
 import json
 import os
-import redis
+import re
 import shutil
-import time
-from omegaconf import OmegaConf
-from concurrent.futures import ThreadPoolExecutor
+import threading
+import uuid
 from pathlib import Path
 
 from flask import Flask, send_from_directory, request, jsonify
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
 
-from cp_train import Cptrain
-from cp_run import Cprun
+from admission import Admission
+from janitor import Janitor
+from jobs import JobQueue
+from metrics import TrainMetrics
+from model_registry import ModelRegistry
+from tasks import TaskRegistry, set_status, get_status
+from settings import cfg, r, BASE_DIR, UPLOAD_DIR, OUTPUT_DIR, CACHE_DIR, FLOWS_DIR, MODELS_DIR, TRAIN_DIR, TEST_DIR
 
 app = Flask(__name__)
 CORS(app)
 
-CONFIG_PATH = Path(__file__).parent / "config.yaml"
-cfg = OmegaConf.load(CONFIG_PATH)
-cfg.data.root_dir = str((CONFIG_PATH.parent / cfg.data.root_dir).resolve())
-BASE_DIR = cfg.data.root_dir
-UPLOAD_DIR = cfg.data.upload_dir
-OUTPUT_DIR = cfg.data.run.output_dir
-MODELS_DIR = str((CONFIG_PATH.parent / cfg.model.save_dir).resolve())
-TRAIN_DIR  = cfg.data.train.train_dir
-TEST_DIR = cfg.data.train.test_dir
 BACKEND_IP = cfg.backend.ip
 BACKEND_PORT = cfg.backend.port
+BACKEND_WORKERS = cfg.backend.get("workers", 2)
+BACKEND_THREADS = cfg.backend.get("threads", 8)
+BACKEND_TIMEOUT = cfg.backend.get("timeout", 300)
+BACKEND_GRACEFUL_TIMEOUT = cfg.backend.get("graceful_timeout", 30)
+QUICKLOOK = cfg.get("segment", {}).get("quicklook", {})
+QUICKLOOK_TIMEOUT = float(cfg.get("worker", {}).get("quicklook_timeout", 30))
+# 预览图片交给计算进程前的临时位置
+QUICKLOOK_UPLOAD_DIR = os.path.join(CACHE_DIR, "quicklook_upload")
+QUICKLOOK_MAX_SIDE = int(QUICKLOOK.get("max_side", 512))
+QUICKLOOK_MAX_SIDE_LIMIT = int(QUICKLOOK.get("max_side_limit", 2048))
+# 预览请求在 web 线程中等待计算进程的结果，每个进程同时等待的预览数有上限，超出时直接返回 429
+QUICKLOOK_SLOTS = threading.BoundedSemaphore(int(QUICKLOOK.get("max_concurrent", 2)))
+BATCH_ROOTS = [os.path.realpath(p) for p in cfg.get("batch", {}).get("allowed_roots", [])]
+BATCH_CHUNK_SIZE = int(cfg.get("batch", {}).get("chunk_size", 8))
+BATCH_EXTENSIONS = tuple(e.lower() for e in cfg.get("batch", {}).get("extensions", [".tif", ".tiff", ".png"]))
 
 os.makedirs(UPLOAD_DIR, exist_ok=True)
-executor = ThreadPoolExecutor(max_workers=4)
-TASKS = {}
-r = redis.Redis(host="127.0.0.1", port=6379, db=0)
-
 # 启动测试服务器
 def run_dev():
+    Janitor.start()
     app.run(host=BACKEND_IP, port=int(BACKEND_PORT))
 
-def set_status(task_id, status, **extra):
-    payload = {"status": status, "updated_at": datetime.datetime.utcnow().isoformat(), **extra}
-    r.set(f"task:{task_id}", json.dumps(payload), ex=86400)  # 1 天过期
+# 启动生产服务器（gunicorn 预派生多进程 + 线程）
+# web worker 只负责接收请求与入队，任务由独立的计算进程（worker.py）执行，web worker 从不导入 cellpose / torch
+def run_prod():
+    from gunicorn.app.base import BaseApplication
+
+    class ProdServer(BaseApplication):
+
+        def load_config(self):
+            self.cfg.set("bind", f"{BACKEND_IP}:{BACKEND_PORT}")
+            self.cfg.set("workers", int(BACKEND_WORKERS))
+            self.cfg.set("threads", int(BACKEND_THREADS))
+            # 上传大文件时请求可能较慢
+            self.cfg.set("timeout", int(BACKEND_TIMEOUT))
+            self.cfg.set("graceful_timeout", int(BACKEND_GRACEFUL_TIMEOUT))
+            self.cfg.set("post_worker_init", on_worker_init)
+            self.cfg.set("worker_exit", on_worker_exit)
 
-def set_train_status(task_id, status, train_losses, test_losses, **extra):
-    payload = {"status": status,
-               "updated_at": datetime.datetime.utcnow().isoformat(),
-               "train_losses": train_losses.tolist() if hasattr(train_losses, "tolist") else train_losses,
-               "test_losses": test_losses.tolist() if hasattr(test_losses, "tolist") else test_losses,
-               **extra}
-    r.set(f"task:{task_id}", json.dumps(payload), ex=86400)  # 1 天过期
+        def load(self):
+            return app
 
-def get_status(task_id):
-    raw = r.get(f"task:{task_id}")
-    return json.loads(raw) if raw else None
+    ProdServer().run()
+
+def on_worker_init(worker):
+    Janitor.start()
+
+def on_worker_exit(server, worker):
+    """
+    worker 退出时只需停止清理线程：任务在计算进程中执行，重启 web worker 不会中断任务。
+    """
+    Janitor.stop()
+
+TRUE_VALUES = ("1", "true", "t", "yes", "y", "on")
+
+def _arg(name, body: dict | None = None):
+    """
+    依次从 JSON 请求体、查询参数、表单中读取参数。
+    """
+    if body and name in body:
+        return body[name]
+    return request.args.get(name) or request.form.get(name)
+
+def _to_float(x, default):
+    try:
+        return float(x)
+    except (TypeError, ValueError):
+        return default
+
+def _to_int(x, default):
+    try:
+        return int(x)
+    except (TypeError, ValueError):
+        return default
+
+def _to_bool(x, default: bool = False) -> bool:
+    if x is None or x == "":
+        return default
+    return str(x).strip().lower() in TRUE_VALUES
+
+def _too_busy(rejection: dict):
+    """
+    准入控制拒绝时的 429 响应，Retry-After 为估计的等待秒数。
+    """
+    resp = jsonify({"ok": False, "error": "server busy", **rejection})
+    resp.status_code = 429
+    resp.headers["Retry-After"] = str(rejection["retry_after"])
+    return resp
 
 @app.route("/")
 def index():
@@ -68,6 +126,7 @@ def test_download():
 @app.get("/dl")
 def download():
     timestamp = request.args.get("id")
+    Janitor.touch(timestamp)
     input_dir = os.path.join(OUTPUT_DIR, timestamp)
     output_dir = os.path.join(OUTPUT_DIR, "tmp", timestamp)  # 不要加 .zip，make_archive 会自动加
     os.makedirs(Path(OUTPUT_DIR) / "tmp", exist_ok=True)  # 确保 tmp 存在
@@ -82,79 +141,262 @@ def run_upload():
     接收上传的文件，并将其发送给cellpose。
     :return:
     """
+    # 过载时在解析请求体（含上传文件）之前就拒绝
+    rejection = Admission.precheck(request.content_length or 0)
+    if rejection is not None:
+        return _too_busy(rejection)
 
     # 从请求中获取参数，若没有则设定为默认值
-    model = request.args.get("model") or request.form.get("model") or "cpsam"
-
-    def _to_float(x, default):
-        try:
-            return float(x)
-        except (TypeError, ValueError):
-            return default
-
-    flow_threshold = _to_float(request.args.get("flow_threshold") or request.form.get("flow_threshold"), 0.4)
-    cellprob_threshold = _to_float(request.args.get("cellprob_threshold") or request.form.get("cellprob_threshold"),
-                                   0.0)
-    diameter_raw = request.args.get("diameter") or request.form.get("diameter")
-    diameter = _to_float(diameter_raw, None) if diameter_raw not in (None, "") else None
+    model = _arg("model") or "cpsam"
+    flow_threshold = _to_float(_arg("flow_threshold"), 0.4)
+    cellprob_threshold = _to_float(_arg("cellprob_threshold"), 0.0)
+    diameter = _to_float(_arg("diameter"), None)
+    auto_diameter = _to_bool(_arg("auto_diameter"))
 
     print("cpt:" + str(cellprob_threshold))
     print("flow:" + str(flow_threshold))
     print("diameter:" + str(diameter))
 
-    # 将文件保存在本地目录中
-    ts = datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S") + f"-{int(time.time()*1000)%1000:03d}"
-    os.makedirs(Path(UPLOAD_DIR) / ts, exist_ok=True)
     files = request.files.getlist("files")
-    saved = []
-    for f in files:
-        if not f or f.filename == "":
-            continue
-        name = secure_filename(f.filename)
-        f.save(os.path.join(UPLOAD_DIR, ts, name))
-        saved.append(os.path.join(UPLOAD_DIR, ts, name))
-
-    # 新建一个线程，防止返回被阻塞
-    def job():
-        return asyncio.run(Cprun.run(
-            images=saved, model=model,
-            cellprob_threshold=cellprob_threshold,
-            flow_threshold=flow_threshold,
-            diameter=diameter, time=ts
-        ))
-
-    # 将线程状态存入redis
-    set_status(ts, "running")
-    fut = executor.submit(job)
-
-    def done_cb(f):
-        try:
-            f.result()
-            set_status(ts, "success")
-        except Exception as e:
-            set_status(ts, "failed", error=str(e))
+    token, rejection = Admission.acquire("run", Admission.run_cost(files), request.content_length or 0)
+    if rejection is not None:
+        return _too_busy(rejection)
 
-    fut.add_done_callback(done_cb)
+    # 将文件保存在本地目录中
+    try:
+        ts = TaskRegistry.create("run", dirs=[UPLOAD_DIR])
+        saved = []
+        for f in files:
+            if not f or f.filename == "":
+                continue
+            name = secure_filename(f.filename)
+            f.save(os.path.join(UPLOAD_DIR, ts, name))
+            saved.append(os.path.join(UPLOAD_DIR, ts, name))
+    except Exception:
+        Admission.release(token)
+        raise
+
+    _submit_run(ts, saved, model=model,
+                cellprob_threshold=cellprob_threshold,
+                flow_threshold=flow_threshold,
+                diameter=diameter, auto_diameter=auto_diameter,
+                admission=token)
 
     return jsonify({"ok": True, "count": len(saved), "id": ts})
 
-@app.post("/train_upload")
-def train_upload():
+def _submit_run(ts, saved, model="cpsam", cellprob_threshold=0.0, flow_threshold=0.4,
+                diameter=None, auto_diameter=False, admission=None):
+    """
+    将分割任务提交给计算进程，并在 redis 中跟踪状态。
 
-    def _to_float(x, default):
-        try:
-            return float(x)
-        except (TypeError, ValueError):
-            return default
+    :param admission: Admission.acquire 返回的令牌，任务结束时释放
+    """
+    JobQueue.submit("run", ts, {
+        "images": saved, "model": model,
+        "cellprob_threshold": cellprob_threshold,
+        "flow_threshold": flow_threshold,
+        "diameter": diameter,
+        "auto_diameter": auto_diameter,
+    }, admission=admission)
+
+@app.post("/quicklook")
+def quicklook():
+    """
+    快速预览：在缩小图或裁剪区域上同步分割，直接返回叠加图。
+    只改阈值时传入上次返回的 cache_key（无需再次上传），仅重新计算掩膜；full=1 时同时提交全分辨率任务。
 
-    def _to_int(x, default):
+    :return:
+    """
+    # 过载时在解析请求体（含上传文件）之前就拒绝
+    rejection = Admission.precheck(request.content_length or 0)
+    if rejection is not None:
+        return _too_busy(rejection)
+
+    model = _arg("model") or "cpsam"
+    flow_threshold = _to_float(_arg("flow_threshold"), 0.4)
+    cellprob_threshold = _to_float(_arg("cellprob_threshold"), 0.0)
+    diameter = _to_float(_arg("diameter"), None)
+    max_side = min(max(1, int(_to_float(_arg("max_side"), QUICKLOOK_MAX_SIDE))), QUICKLOOK_MAX_SIDE_LIMIT)
+    full = _to_bool(_arg("full"))
+
+    crop = None
+    if _arg("crop"):
+        try:
+            crop = tuple(int(v) for v in _arg("crop").split(","))
+            assert len(crop) == 4 and min(crop) >= 0 and crop[2] > 0 and crop[3] > 0
+        except (ValueError, AssertionError):
+            return jsonify({"ok": False, "error": "crop must be x,y,w,h"}), 400
+
+    cache_key = _arg("cache_key")
+    if cache_key and not re.fullmatch(r"[0-9a-f]{40}", cache_key):
+        return jsonify({"ok": False, "error": "invalid cache_key"}), 400
+
+    f = request.files.get("file")
+    data = f.read() if f and f.filename else None
+    if data is None and not cache_key:
+        return jsonify({"ok": False, "error": "no image received"}), 400
+
+    if not QUICKLOOK_SLOTS.acquire(blocking=False):
+        return _too_busy({"reason": "quicklook", "retry_after": 1})
+    # 预览本身也计入准入：与排队中的任务共享 CPU / GPU
+    preview_token, rejection = Admission.acquire("quicklook", Admission.quicklook_cost(max_side))
+    if rejection is not None:
+        QUICKLOOK_SLOTS.release()
+        return _too_busy(rejection)
+
+    # 全分辨率任务与 /run_upload 一样占用准入名额，被拒绝时不做预览
+    token = None
+    if full and data is not None:
+        token, rejection = Admission.acquire("run", Admission.run_cost([f]), len(data))
+        if rejection is not None:
+            QUICKLOOK_SLOTS.release()
+            Admission.release(preview_token)
+            return _too_busy(rejection)
+
+    upload = None
+    try:
+        if data is not None:
+            os.makedirs(QUICKLOOK_UPLOAD_DIR, exist_ok=True)
+            upload = os.path.join(QUICKLOOK_UPLOAD_DIR, uuid.uuid4().hex)
+            with open(upload, "wb") as fp:
+                fp.write(data)
+        # 推理在计算进程中执行，这里最多等待 quicklook_timeout 秒
+        result = JobQueue.call("quicklook", {
+            "upload": upload, "filename": f.filename if data else "image.tif",
+            "cache_key": None if data else cache_key,
+            "model": model, "diameter": diameter,
+            "flow_threshold": flow_threshold,
+            "cellprob_threshold": cellprob_threshold,
+            "max_side": max_side, "crop": crop,
+        }, timeout=QUICKLOOK_TIMEOUT)
+    except FileNotFoundError as e:
+        Admission.release(token)
+        return jsonify({"ok": False, "error": str(e)}), 404
+    except ValueError as e:
+        Admission.release(token)
+        return jsonify({"ok": False, "error": str(e)}), 400
+    except TimeoutError:
+        Admission.release(token)
+        return _too_busy({"reason": "timeout", "retry_after": int(QUICKLOOK_TIMEOUT)})
+    except Exception:
+        Admission.release(token)
+        raise
+    finally:
+        QUICKLOOK_SLOTS.release()
+        Admission.release(preview_token)
+        if upload:
+            Path(upload).unlink(missing_ok=True)
+
+    if full and data is not None:
         try:
-            return int(x)
-        except (TypeError, ValueError):
-            return default
+            ts = TaskRegistry.create("run", dirs=[UPLOAD_DIR])
+            path = os.path.join(UPLOAD_DIR, ts, secure_filename(f.filename))
+            with open(path, "wb") as fp:
+                fp.write(data)
+        except Exception:
+            Admission.release(token)
+            raise
+        _submit_run(ts, [path], model=model,
+                    cellprob_threshold=cellprob_threshold,
+                    flow_threshold=flow_threshold,
+                    diameter=diameter, admission=token)
+        result["id"] = ts
+
+    return jsonify({"ok": True, **result})
+
+@app.post("/stack_upload")
+def stack_upload():
+    """
+    上传多页 TIFF（z-stack 或时间序列），按块流式分割并拼接 / 跟踪标签。
+
+    :return:
+    """
+    # 过载时在解析请求体（含上传文件）之前就拒绝
+    rejection = Admission.precheck(request.content_length or 0)
+    if rejection is not None:
+        return _too_busy(rejection)
+
+    mode = _arg("mode") or "z"
+    if mode not in ("z", "t"):
+        return jsonify({"ok": False, "error": "mode must be z or t"}), 400
+    f = request.files.get("file")
+    if not f or f.filename == "":
+        return jsonify({"ok": False, "error": "no image received"}), 400
+    name = secure_filename(f.filename)
+    if not name.lower().endswith((".tif", ".tiff")):
+        return jsonify({"ok": False, "error": "stack must be a multi-page TIFF"}), 400
+
+    model = _arg("model") or "cpsam"
+    kwargs = dict(
+        model=model,
+        mode=mode,
+        do_3D=_to_bool(_arg("do_3D")),
+        diameter=_to_float(_arg("diameter"), None),
+        flow_threshold=_to_float(_arg("flow_threshold"), 0.4),
+        cellprob_threshold=_to_float(_arg("cellprob_threshold"), 0.0),
+    )
+    for key in ("chunk_size", "workers"):
+        if _arg(key):
+            kwargs[key] = max(1, _to_int(_arg(key), 1))
+    if _arg("stitch_threshold"):
+        kwargs["stitch_threshold"] = _to_float(_arg("stitch_threshold"), 0.25)
+
+    # 按所有平面的总像素数估计耗时（只读取 TIFF 头）
+    token, rejection = Admission.acquire("stack", Admission.run_cost([f]), request.content_length or 0)
+    if rejection is not None:
+        return _too_busy(rejection)
+
+    try:
+        ts = TaskRegistry.create("stack", dirs=[UPLOAD_DIR])
+        path = os.path.join(UPLOAD_DIR, ts, name)
+        f.save(path)
+    except Exception:
+        Admission.release(token)
+        raise
+
+    JobQueue.submit("stack", ts, {"path": path, **kwargs}, admission=token)
+
+    return jsonify({"ok": True, "id": ts})
+
+@app.post("/resegment")
+def resegment():
+    """
+    以新的 flow_threshold / cellprob_threshold 重新分割已完成的任务。
+    只使用该任务保存的网络输出重建掩膜，不再运行网络；结果作为新任务返回。
+
+    :return:
+    """
+    source = secure_filename(_arg("id") or "")
+    flow_threshold = _to_float(_arg("flow_threshold"), 0.4)
+    cellprob_threshold = _to_float(_arg("cellprob_threshold"), 0.0)
+    if not source or not (Path(FLOWS_DIR) / source).is_dir():
+        return jsonify({"ok": False, "error": "no saved flows for this task"}), 404
+
+    n_flows = sum(1 for p in (Path(FLOWS_DIR) / source).iterdir() if p.suffix == ".npz")
+    token, rejection = Admission.acquire("resegment", Admission.resegment_cost(n_flows))
+    if rejection is not None:
+        return _too_busy(rejection)
+
+    try:
+        ts = TaskRegistry.create("resegment", dirs=[OUTPUT_DIR], source=source)
+    except Exception:
+        Admission.release(token)
+        raise
+
+    JobQueue.submit("resegment", ts, {
+        "source": source,
+        "flow_threshold": flow_threshold,
+        "cellprob_threshold": cellprob_threshold,
+    }, admission=token, status={"source": source})
+
+    return jsonify({"ok": True, "id": ts, "source": source})
+
+@app.post("/train_upload")
+def train_upload():
+    lr_schedule = request.args.get("lr_schedule") or "default"
+    if lr_schedule not in ("default", "cosine", "plateau"):
+        return jsonify({"ok": False, "error": f"unknown lr_schedule: {lr_schedule}"}), 400
 
-    ts = datetime.datetime.now().strftime("%Y-%m-%d-%H-%M-%S") + f"-{int(time.time()*1000)%1000:03d}"
-    model_name = request.args.get("model_name") or f"custom_model-{ts}"
     image_filter = request.args.get("image_filter") or "_img"
     mask_filter = request.args.get("mask_filter") or "_masks"
     base_model = request.args.get("base_model") or "cpsam"
@@ -162,79 +404,221 @@ def train_upload():
     learning_rate = _to_float(request.args.get("learning_rate"), 5e-5)
     n_epochs = _to_int(request.args.get("n_epochs"), 100)
     weight_decay = _to_float(request.args.get("weight_decay"), 0.1)
-    normalize = request.args.get(
-        "normalize",
-        default=True,
-        type=lambda v: str(v).strip().lower() in ("1","true","t","yes","y","on")
-    )
-    compute_flows = request.args.get(
-        "compute_flows",
-        default=True,
-        type=lambda v: str(v).strip().lower() in ("1","true","t","yes","y","on")
-    )
+    normalize = _to_bool(request.args.get("normalize"), True)
+    compute_flows = _to_bool(request.args.get("compute_flows"), True)
     min_train_masks = _to_int(request.args.get(" min_train_masks"), 5)
     nimg_per_epoch = _to_int(request.args.get("nimg_per_epoch"), None)
-    rescale = request.args.get(
-        "rescale",
-        default=False,
-        type=lambda v: str(v).strip().lower() in ("1","true","t","yes","y","on")
-    )
+    rescale = _to_bool(request.args.get("rescale"), False)
     scale_range = _to_float(request.args.get("scale_range"), None)
     channel_axis = _to_int(request.args.get("channel_axis"), None)
+    bf16 = _to_bool(request.args.get("bf16"), False)
+    grad_accum_steps = max(1, _to_int(request.args.get("grad_accum_steps"), 1))
+    activation_checkpointing = _to_bool(request.args.get("activation_checkpointing"), False)
+    # 数据并行进程数，不超过 CPU 核数
+    n_ranks = min(max(1, _to_int(request.args.get("n_ranks"), 1)), os.cpu_count() or 1)
+    early_stopping_patience = max(0, _to_int(request.args.get("early_stopping_patience"), 0))
+    min_delta = _to_float(request.args.get("min_delta"), 0.)
+    restore_best = _to_bool(request.args.get("restore_best"), True)
+    test_every = max(1, _to_int(request.args.get("test_every"), 10))
+
+    # 过载时在解析请求体（含上传文件）之前就拒绝
+    rejection = Admission.precheck(request.content_length or 0)
+    if rejection is not None:
+        return _too_busy(rejection)
 
     train_files = request.files.getlist("train_files")
     test_files = request.files.getlist("test_files")
-    os.makedirs(Path(TRAIN_DIR) /  ts, exist_ok=True)
-    os.makedirs(Path(TEST_DIR) / ts, exist_ok=True)
-    set_status(ts, "pending")
-    saved = []
-    for f in train_files:
-        if not f or f.filename == "":
-            continue
-        name = secure_filename(f.filename)
-        f.save(os.path.join(TRAIN_DIR, ts, name))
-        saved.append(os.path.join(TRAIN_DIR, ts, name))
-
-    for f in test_files:
-        if not f or f.filename == "":
-            continue
-        name = secure_filename(f.filename)
-        f.save(os.path.join(TEST_DIR, ts, name))
-        saved.append(os.path.join(TEST_DIR, ts, name))
-
-    def job():
-        return asyncio.run(Cptrain.start_train(
-            time=ts,
-            model_name=model_name,
-            image_filter=image_filter,
-            mask_filter=mask_filter,
-            base_model=base_model,
-            batch_size=batch_size,
-            learning_rate=learning_rate,
-            n_epochs=n_epochs,
-            weight_decay=weight_decay,
-            normalize=normalize,
-            compute_flows=compute_flows,
-            min_train_masks=min_train_masks,
-            nimg_per_epoch=nimg_per_epoch,
-            rescale=rescale,
-            scale_range=scale_range,
-            channel_axis=channel_axis,
-        ))
-
-    fut = executor.submit(job)
-
-    def done_cb(f):
-        try:
-            train_losses, test_losses = f.result()
-            set_train_status(ts, "success", train_losses, test_losses)
-        except Exception as e:
-            set_status(ts, "failed", error=str(e))
+    # 训练开销按 epoch 数 × 训练图片数（不含掩膜文件）估计
+    n_images = sum(1 for f in train_files if f and image_filter in f.filename) or len(train_files)
+    token, rejection = Admission.acquire("train", Admission.train_cost(n_images, n_epochs, n_ranks),
+                                         request.content_length or 0)
+    if rejection is not None:
+        return _too_busy(rejection)
+
+    try:
+        ts = TaskRegistry.create("train", dirs=[TRAIN_DIR, TEST_DIR])
+        saved = []
+        for f in train_files:
+            if not f or f.filename == "":
+                continue
+            name = secure_filename(f.filename)
+            f.save(os.path.join(TRAIN_DIR, ts, name))
+            saved.append(os.path.join(TRAIN_DIR, ts, name))
+
+        for f in test_files:
+            if not f or f.filename == "":
+                continue
+            name = secure_filename(f.filename)
+            f.save(os.path.join(TEST_DIR, ts, name))
+            saved.append(os.path.join(TEST_DIR, ts, name))
+    except Exception:
+        Admission.release(token)
+        raise
+    model_name = request.args.get("model_name") or f"custom_model-{ts}"
 
-    fut.add_done_callback(done_cb)
+    JobQueue.submit("train", ts, {
+        "model_name": model_name,
+        "image_filter": image_filter,
+        "mask_filter": mask_filter,
+        "base_model": base_model,
+        "batch_size": batch_size,
+        "learning_rate": learning_rate,
+        "n_epochs": n_epochs,
+        "weight_decay": weight_decay,
+        "normalize": normalize,
+        "compute_flows": compute_flows,
+        "min_train_masks": min_train_masks,
+        "nimg_per_epoch": nimg_per_epoch,
+        "rescale": rescale,
+        "scale_range": scale_range,
+        "channel_axis": channel_axis,
+        "bf16": bf16,
+        "grad_accum_steps": grad_accum_steps,
+        "activation_checkpointing": activation_checkpointing,
+        "n_ranks": n_ranks,
+        "lr_schedule": lr_schedule,
+        "early_stopping_patience": early_stopping_patience,
+        "min_delta": min_delta,
+        "restore_best": restore_best,
+        "test_every": test_every,
+    }, admission=token)
 
     return jsonify({"ok": True, "count": len(saved), "id": ts})
 
+def _resolve_batch_files(pattern: str, recursive: bool = False):
+    """
+    将目录或 glob 解析为图片列表，所有文件必须位于 batch.allowed_roots 之内。
+
+    :return: (图片路径列表, 输出命名所用的根目录)
+    """
+    def allowed(path):
+        rp = os.path.realpath(path)
+        return any(os.path.commonpath([rp, root]) == root for root in BATCH_ROOTS)
+
+    if any(c in pattern for c in "*?["):
+        # 先校验不含通配符的前缀，避免在允许的目录之外展开 glob（如 /**/*.tif 会遍历整个文件系统）
+        parts = Path(pattern).parts
+        if ".." in parts:
+            raise PermissionError(f"'..' is not allowed in glob patterns: {pattern}")
+        prefix = []
+        for part in parts:
+            if any(c in part for c in "*?["):
+                break
+            prefix.append(part)
+        if not prefix or not allowed(os.path.join(*prefix)):
+            raise PermissionError(f"path not under an allowed root: {pattern}")
+        # glob 匹配到的每个文件仍会单独校验（符号链接可能指向允许目录之外）
+        files = glob.glob(pattern, recursive=recursive)
+        # 以不含通配符的前缀为根目录，与匹配到哪些文件无关
+        root = os.path.join(*prefix)
+    elif os.path.isdir(pattern):
+        if not allowed(pattern):
+            raise PermissionError(f"path not under an allowed root: {pattern}")
+        root = pattern
+        if recursive:
+            files = [os.path.join(d, n) for d, _, names in os.walk(pattern) for n in names]
+        else:
+            files = [os.path.join(pattern, n) for n in os.listdir(pattern)]
+    else:
+        raise ValueError(f"not a directory or glob: {pattern}")
+
+    files = sorted(f for f in files
+                   if os.path.isfile(f) and f.lower().endswith(BATCH_EXTENSIONS) and allowed(f))
+    return files, root
+
+@app.post("/batch_run")
+def batch_run():
+    """
+    对服务器本地目录（或 glob）中的图片批量分割，输入文件不会被复制。
+    传入 resume=<id> 时继续之前中断的任务，已完成的图片会被跳过。
+
+    :return:
+    """
+    if not BATCH_ROOTS:
+        return jsonify({"ok": False, "error": "batch.allowed_roots is not configured"}), 403
+
+    body = request.get_json(silent=True) or {}
+    resume = _arg("resume", body)
+    if resume:
+        ts = secure_filename(str(resume))
+        params_path = Path(OUTPUT_DIR) / ts / ".batch.json"
+        if not params_path.exists():
+            return jsonify({"ok": False, "error": "batch task not found"}), 404
+        params = json.loads(params_path.read_text(encoding="utf-8"))
+        # 同一任务不能同时运行两份，否则会重复写输出和检查点；以租约判断，计算进程退出后租约很快过期，
+        # 不受停留在 running 的任务状态影响
+        if JobQueue.is_live(ts):
+            return jsonify({"ok": False, "error": "batch task is already running", "id": ts}), 409
+    else:
+        ts = None
+        params = {
+            "path": _arg("path", body),
+            "recursive": _to_bool(_arg("recursive", body)),
+            "model": _arg("model", body) or "cpsam",
+            "flow_threshold": _to_float(_arg("flow_threshold", body), 0.4),
+            "cellprob_threshold": _to_float(_arg("cellprob_threshold", body), 0.0),
+            "diameter": _to_float(_arg("diameter", body), None),
+            "chunk_size": max(1, _to_int(_arg("chunk_size", body), BATCH_CHUNK_SIZE)),
+            "auto_diameter": _to_bool(_arg("auto_diameter", body)),
+        }
+        if not params["path"]:
+            return jsonify({"ok": False, "error": "path is required"}), 400
+
+    try:
+        files, root = _resolve_batch_files(params["path"], params["recursive"])
+    except PermissionError as e:
+        return jsonify({"ok": False, "error": str(e)}), 403
+    except ValueError as e:
+        return jsonify({"ok": False, "error": str(e)}), 400
+    if not files:
+        return jsonify({"ok": False, "error": "no images matched"}), 400
+    # 输出文件名与检查点按相对于 root 的路径记录，续跑时必须沿用创建时的 root
+    root = params.get("root") or root
+    params["root"] = root
+
+    # 续跑时已完成的图片记录在检查点文件中，不计入估计耗时
+    checkpoint = Path(OUTPUT_DIR) / ts / ".done" if ts else None
+    n_done = len(set(checkpoint.read_text(encoding="utf-8").split())) if checkpoint and checkpoint.exists() else 0
+    token, rejection = Admission.acquire("batch", Admission.batch_cost(max(0, len(files) - n_done)))
+    if rejection is not None:
+        return _too_busy(rejection)
+
+    try:
+        if ts is None:
+            ts = TaskRegistry.create("batch", dirs=[OUTPUT_DIR])
+        (Path(OUTPUT_DIR) / ts / ".batch.json").write_text(json.dumps(params), encoding="utf-8")
+    except Exception:
+        Admission.release(token)
+        raise
+    # 计数随任务状态一起更新，由计算进程在每张图片处理完后写入
+    counts = {"total": len(files), "done": n_done, "failed": 0}
+    submitted = JobQueue.submit("batch", ts, {
+        "images": files, "root": root,
+        "model": params["model"],
+        "cellprob_threshold": params["cellprob_threshold"],
+        "flow_threshold": params["flow_threshold"],
+        "diameter": params["diameter"],
+        "chunk_size": params["chunk_size"],
+        "auto_diameter": params.get("auto_diameter", False),
+    }, admission=token, status=counts, exclusive=bool(resume))
+    if not submitted:
+        Admission.release(token)
+        return jsonify({"ok": False, "error": "batch task is already running", "id": ts}), 409
+
+    return jsonify({"ok": True, "count": len(files), "id": ts})
+
+@app.get("/batch_files")
+def batch_files():
+    """
+    批量任务中每张图片的处理状态
+
+    :return:
+    """
+    task_id = request.args.get("id")
+    raw = r.hgetall(f"task:{task_id}:files")
+    files = {k.decode(): json.loads(v) for k, v in raw.items()}
+    return jsonify({"ok": True, "count": len(files), "files": files}), 200
+
 @app.get("/status")
 def status():
     """
@@ -249,12 +633,35 @@ def status():
         return jsonify({"ok": True, "exists": False, "status": "not_found"}), 200
     return jsonify({"ok": True, "exists": True, **st}), 200
 
+@app.get("/train_metrics")
+def train_metrics():
+    """
+    训练任务的逐 epoch 指标，since 为起始 epoch，前端轮询时只取新增部分。
+
+    :return:
+    """
+    task_id = request.args.get("id")
+    if not task_id:
+        return jsonify({"ok": False, "error": "missing id"}), 400
+    try:
+        since = max(0, int(request.args.get("since", 0)))
+    except ValueError:
+        return jsonify({"ok": False, "error": "since must be an integer"}), 400
+    st = get_status(task_id)
+    if not st:
+        return jsonify({"ok": True, "exists": False, "status": "not_found"}), 200
+    metrics = TrainMetrics.read(task_id, since)
+    return jsonify({"ok": True, "exists": True, "status": st.get("status"),
+                    "since": since, "next": since + len(metrics["epoch"]),
+                    "metrics": metrics}), 200
+
 @app.get("/preview")
 def preview():
     task_id = request.args.get('id')
     task_dir = Path(OUTPUT_DIR) / task_id
     if not task_dir.exists():
         return jsonify({"ok": False, "error": "task not found"}), 200
+    Janitor.touch(task_id)
 
     # 找出所有 *_overlay.png 文件
     files = sorted(task_dir.glob("*_overlay.png"))
@@ -275,8 +682,17 @@ def preview():
 
 @app.get("/models")
 def list_models():
-    models_list = os.listdir(MODELS_DIR)
-    return jsonify({"ok": True, "models": models_list})
+    """
+    从模型索引中返回模型列表及元数据，支持 If-None-Match 协商缓存，refresh=1 时重新扫描模型目录
+
+    :return:
+    """
+    if _to_bool(request.args.get("refresh")):
+        ModelRegistry.rebuild()
+    details, etag = ModelRegistry.get()
+    resp = jsonify({"ok": True, "models": [m["name"] for m in details], "details": details})
+    resp.set_etag(etag)
+    return resp.make_conditional(request)
 
 @app.get("/result")
 def list_results():
@@ -285,3 +701,37 @@ def list_results():
     if not st:
         return jsonify({"ok": True, "exists": False, "status": "not_found"}), 200
     return jsonify({"ok": True, "exists": True, **st}), 200
+
+@app.get("/load")
+def load():
+    """
+    当前任务积压、剩余资源与准入限制，accepting 为 false 时新任务会收到 429。
+
+    :return:
+    """
+    return jsonify({"ok": True, **Admission.load()}), 200
+
+@app.get("/cleanup")
+def cleanup_report():
+    """
+    磁盘占用与清理报告，refresh=1 时重新统计当前占用
+
+    :return:
+    """
+    refresh = _to_bool(request.args.get("refresh"))
+    return jsonify({"ok": True, **Janitor.report(refresh=refresh)}), 200
+
+@app.get("/tasks")
+def list_tasks():
+    """
+    按创建时间倒序列出最近的任务，可按 kind（run / train / batch）过滤
+
+    :return:
+    """
+    try:
+        limit = min(max(int(request.args.get("limit", 20)), 1), 500)
+    except ValueError:
+        limit = 20
+    kind = request.args.get("kind") or None
+    tasks = TaskRegistry.recent(limit=limit, kind=kind)
+    return jsonify({"ok": True, "count": len(tasks), "tasks": tasks}), 200
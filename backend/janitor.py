@@ -0,0 +1,224 @@
+import datetime
+import json
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+
+from jobs import JobQueue
+from settings import cfg, r, UPLOAD_DIR, OUTPUT_DIR, TRAIN_DIR, TEST_DIR, CACHE_DIR, FLOWS_DIR
+
+CLEANUP = cfg.get("cleanup", {})
+ENABLED = bool(CLEANUP.get("enabled", True))
+INTERVAL = int(CLEANUP.get("interval", 600))
+BATCH_SIZE = int(CLEANUP.get("batch_size", 50))
+GRACE = int(CLEANUP.get("grace", 600))
+RETENTION = dict(CLEANUP.get("retention", {}))
+QUOTA_BYTES = int(float(CLEANUP.get("quota_gb", 0)) * 1024 ** 3)
+
+LOCK_KEY = "janitor:lock"
+REPORT_KEY = "janitor:report"
+
+
+class Janitor:
+    """
+    后台清理线程。
+
+    按产物类别（上传、输出、临时压缩包、训练数据、缓存）的保留时长删除过期条目，
+    再按最近使用时间淘汰，直到总占用低于配额。多进程部署时通过 redis 锁保证同一时刻只有一个进程在清理。
+    最近使用时间只看 mtime（写入或 touch 时更新）：扫描目录本身会更新 atime（relatime 下每 24 小时一次），不能用作依据。
+    """
+
+    _thread = None
+    _stop = threading.Event()
+
+    @classmethod
+    def artifact_classes(cls) -> dict[str, list[Path]]:
+        """
+        每一类产物所在的父目录，父目录下的每个条目对应一个任务。
+        """
+        return {
+            "uploads": [Path(UPLOAD_DIR)],
+            "outputs": [Path(OUTPUT_DIR)],
+            "tmp_zips": [Path(OUTPUT_DIR) / "tmp"],
+            "train_data": [Path(TRAIN_DIR), Path(TEST_DIR)],
+            "cache": [Path(CACHE_DIR) / "quicklook", Path(CACHE_DIR) / "quicklook_upload"],
+            "flows": [Path(FLOWS_DIR)],
+        }
+
+    @classmethod
+    def start(cls):
+        if not ENABLED or (cls._thread is not None and cls._thread.is_alive()):
+            return
+        cls._stop.clear()
+        cls._thread = threading.Thread(target=cls._loop, name="janitor", daemon=True)
+        cls._thread.start()
+
+    @classmethod
+    def stop(cls):
+        cls._stop.set()
+
+    @classmethod
+    def _loop(cls):
+        while not cls._stop.wait(INTERVAL):
+            # 多个 worker 同时运行时只让抢到锁的那个清理
+            if not r.set(LOCK_KEY, os.getpid(), nx=True, ex=max(INTERVAL - 1, 1)):
+                continue
+            try:
+                cls.sweep()
+            except Exception as e:
+                print(f"清理失败: {e}")
+
+    @classmethod
+    def touch(cls, task_id: str):
+        """
+        标记任务最近被访问过（预览、下载），用于 LRU 淘汰。task_id 来自请求参数，只接受单级目录名。
+        """
+        if not task_id or task_id in (".", "..") or Path(task_id).name != task_id:
+            return
+        now = time.time()
+        for dirs in cls.artifact_classes().values():
+            for d in dirs:
+                p = d / task_id
+                if p.is_dir():
+                    os.utime(p, (now, now))
+
+    @staticmethod
+    def _task_id(entry: Path) -> str:
+        return entry.stem if entry.is_file() else entry.name
+
+    @staticmethod
+    def _size(entry: Path) -> int:
+        if entry.is_file():
+            return entry.stat().st_size
+        total = 0
+        for root, _, files in os.walk(entry):
+            for name in files:
+                try:
+                    total += os.path.getsize(os.path.join(root, name))
+                except OSError:
+                    pass
+        return total
+
+    @classmethod
+    def scan(cls) -> list[dict]:
+        """
+        列出所有产物条目及其大小、最近使用时间。
+        """
+        entries = []
+        for kind, dirs in cls.artifact_classes().items():
+            for d in dirs:
+                if not d.exists():
+                    continue
+                for entry in d.iterdir():
+                    # tmp 目录本身属于 tmp_zips
+                    if kind == "outputs" and entry.name == "tmp":
+                        continue
+                    if kind == "tmp_zips" and entry.suffix != ".zip":
+                        continue
+                    try:
+                        st = entry.stat()
+                    except OSError:
+                        continue
+                    entries.append({
+                        "kind": kind,
+                        "path": entry,
+                        "task_id": cls._task_id(entry),
+                        "size": cls._size(entry),
+                        "last_used": st.st_mtime,
+                    })
+        return entries
+
+    @staticmethod
+    def _is_active(task_id: str) -> bool:
+        # 任务排队或执行期间持有租约（由计算进程按心跳续约），与任务状态的过期时间无关
+        return JobQueue.is_live(task_id)
+
+    @classmethod
+    def _usage(cls, entries: list[dict]) -> dict:
+        usage = {kind: {"count": 0, "bytes": 0} for kind in cls.artifact_classes()}
+        for e in entries:
+            usage[e["kind"]]["count"] += 1
+            usage[e["kind"]]["bytes"] += e["size"]
+        return usage
+
+    @classmethod
+    def sweep(cls) -> dict:
+        """
+        执行一次清理，返回清理报告。
+        """
+        t0 = time.time()
+        entries = cls.scan()
+        before = sum(e["size"] for e in entries)
+
+        victims = []
+        kept = []
+        for e in entries:
+            keep_hours = float(RETENTION.get(e["kind"], 0))
+            if keep_hours > 0 and t0 - e["last_used"] > keep_hours * 3600:
+                victims.append(e)
+            else:
+                kept.append(e)
+
+        # 超出配额时按最近使用时间从旧到新淘汰
+        remaining = before - sum(e["size"] for e in victims)
+        if QUOTA_BYTES > 0 and remaining > QUOTA_BYTES:
+            for e in sorted(kept, key=lambda x: x["last_used"]):
+                if remaining <= QUOTA_BYTES:
+                    break
+                victims.append(e)
+                remaining -= e["size"]
+
+        deleted, skipped, freed = [], [], 0
+        for i in range(0, len(victims), BATCH_SIZE):
+            for e in victims[i:i + BATCH_SIZE]:
+                if t0 - e["last_used"] < GRACE or cls._is_active(e["task_id"]):
+                    skipped.append(str(e["path"]))
+                    continue
+                if e["path"].is_dir():
+                    shutil.rmtree(e["path"], ignore_errors=True)
+                else:
+                    e["path"].unlink(missing_ok=True)
+                deleted.append(str(e["path"]))
+                freed += e["size"]
+            # 批次之间让出 IO
+            time.sleep(0.05)
+
+        deleted_set = set(deleted)
+        report = {
+            "updated_at": datetime.datetime.utcnow().isoformat(),
+            "elapsed": time.time() - t0,
+            "bytes_before": before,
+            "bytes_after": before - freed,
+            "bytes_freed": freed,
+            "quota_bytes": QUOTA_BYTES,
+            "deleted": len(deleted),
+            "skipped_active": len(skipped),
+            "usage": cls._usage([e for e in entries if str(e["path"]) not in deleted_set]),
+        }
+        r.set(REPORT_KEY, json.dumps(report))
+        print(f"清理完成: 删除 {len(deleted)} 项，释放 {freed / 1024 ** 2:.1f} MB")
+        return report
+
+    @classmethod
+    def report(cls, refresh: bool = False) -> dict:
+        """
+        当前磁盘占用与上一次清理的报告。
+        """
+        raw = r.get(REPORT_KEY)
+        last = json.loads(raw) if raw else None
+        if not refresh and last is not None:
+            return {
+                "last_sweep": last,
+                "usage": last["usage"],
+                "total_bytes": last["bytes_after"],
+                "quota_bytes": QUOTA_BYTES,
+            }
+        entries = cls.scan()
+        return {
+            "last_sweep": last,
+            "usage": cls._usage(entries),
+            "total_bytes": sum(e["size"] for e in entries),
+            "quota_bytes": QUOTA_BYTES,
+        }
@@ -0,0 +1,91 @@
+import json
+import math
+import time
+import uuid
+
+from settings import cfg, r
+from tasks import set_status
+
+WORKER = cfg.get("worker", {})
+LEASE_TTL = int(WORKER.get("lease_ttl", 60))
+# 排队中的任务同样持有租约，直到计算进程开始执行；与准入令牌的租约一致
+QUEUED_TTL = int(cfg.get("admission", {}).get("lease", 21600))
+
+QUEUE_KEY = "jobs:queue"              # 列表：分割 / 训练等普通任务
+QUICK_QUEUE_KEY = "jobs:queue:quick"  # 列表：快速预览，由单独的线程执行，不排在长任务之后
+RUNNING_KEY = "jobs:running"          # 哈希：任务 ID -> 正在执行的任务，用于发现被中断的任务
+REPLY_TTL = 60
+
+
+class JobQueue:
+    """
+    web 进程与计算进程（worker.py）之间的任务队列。
+
+    web 进程只把任务写入 redis 列表，从不导入 cellpose / torch；计算进程取出任务执行并更新 task:{id}。
+    每个任务持有租约 task:{id}:lease：入队时写入，执行期间由计算进程按心跳续约，结束时删除。
+    租约存在即说明任务仍在排队或执行，计算进程崩溃后租约在 lease_ttl 秒内过期。
+    """
+
+    @staticmethod
+    def lease_key(task_id: str) -> str:
+        return f"task:{task_id}:lease"
+
+    @classmethod
+    def submit(cls, kind: str, task_id: str, params: dict, admission: str | None = None,
+               status: dict | None = None, exclusive: bool = False) -> bool:
+        """
+        提交任务，任务状态置为 running。
+
+        :param kind: 任务类型，对应 worker.HANDLERS 中的处理函数
+        :param task_id: 任务 ID
+        :param params: 处理函数的参数，必须可 JSON 序列化
+        :param admission: Admission.acquire 返回的令牌，任务结束时由计算进程释放
+        :param status: 每次写入任务状态时附带的字段（如批量任务的计数）
+        :param exclusive: 同一任务已在排队或执行（租约存在）时不提交，用于续跑已有任务
+        :return: 是否已提交
+        """
+        job = {"kind": kind, "task_id": task_id, "params": params, "admission": admission,
+               "status": status or {}, "submitted_at": time.time()}
+        if not r.set(cls.lease_key(task_id), "queued", ex=QUEUED_TTL, nx=exclusive):
+            return False
+        set_status(task_id, "running", **(status or {}))
+        r.rpush(QUEUE_KEY, json.dumps(job))
+        return True
+
+    @classmethod
+    def renew(cls, task_id: str):
+        """
+        执行中的任务续约，由计算进程的心跳线程及任务进度回调调用。
+        """
+        r.expire(cls.lease_key(task_id), LEASE_TTL)
+
+    @classmethod
+    def is_live(cls, task_id: str) -> bool:
+        """
+        任务是否仍在排队或执行（租约未过期）。
+        """
+        return bool(task_id) and bool(r.exists(cls.lease_key(task_id)))
+
+    @classmethod
+    def call(cls, kind: str, params: dict, timeout: float) -> dict:
+        """
+        提交快速任务并等待结果。超时后计算进程会跳过尚未开始的任务。
+
+        :return: 处理函数的返回值
+        :raises TimeoutError: timeout 秒内没有结果
+        """
+        job_id = uuid.uuid4().hex
+        reply = f"jobs:reply:{job_id}"
+        job = {"kind": kind, "job_id": job_id, "params": params, "reply": reply,
+               "deadline": time.time() + timeout}
+        r.rpush(QUICK_QUEUE_KEY, json.dumps(job))
+        got = r.blpop([reply], timeout=max(1, math.ceil(timeout)))
+        if got is None:
+            raise TimeoutError(f"{kind} did not finish within {timeout:g}s")
+        result = json.loads(got[1])
+        if "error" in result:
+            # 计算进程中的参数错误、缓存过期等按原异常类型抛出，由接口转换为 4xx
+            exc = {"ValueError": ValueError, "FileNotFoundError": FileNotFoundError}.get(result.get("type"),
+                                                                                        RuntimeError)
+            raise exc(result["error"])
+        return result["result"]
@@ -0,0 +1,499 @@
+"""
+压力测试：在进程内并发请求 /run_upload、/status、/preview、/dl、/train_upload，
+统计各接口的延迟分位数 (p50/p95/p99)、吞吐量与内存增长，用于容量规划；被准入控制拒绝的请求 (429) 单独计数。
+
+分割与训练由延迟可调的假引擎代替（输出合成掩膜），计算进程在本进程的线程中运行，redis 由内存实现代替，
+因此无需 cellpose 模型与 redis 服务。每个接口单独一个阶段，内存增长为该阶段前后的 RSS 之差。
+
+用法::
+
+    python loadtest.py [--concurrency 16] [--requests 200] [--latency 0.2]
+"""
+import argparse
+import contextlib
+import fnmatch
+import gc
+import io
+import json
+import random
+import shutil
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+import settings
+
+
+class MemoryRedis:
+    """
+    进程内的 redis 替身，只实现本服务用到的命令；过期在读取时惰性判断。
+    """
+
+    def __init__(self):
+        self._data = {}
+        self._expire = {}
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def _b(value) -> bytes:
+        if isinstance(value, bytes):
+            return value
+        return str(value).encode()
+
+    def _get(self, key, default=None):
+        exp = self._expire.get(key)
+        if exp is not None and exp <= time.time():
+            self._data.pop(key, None)
+            self._expire.pop(key, None)
+        return self._data.get(key, default)
+
+    def _store(self, key, value, ex=None):
+        self._data[key] = value
+        if ex is not None:
+            self._expire[key] = time.time() + ex
+        else:
+            self._expire.pop(key, None)
+
+    def get(self, key):
+        with self._lock:
+            return self._get(key)
+
+    def set(self, key, value, ex=None, nx=False):
+        with self._lock:
+            if nx and self._get(key) is not None:
+                return None
+            self._store(key, self._b(value), ex)
+            return True
+
+    def delete(self, *keys):
+        with self._lock:
+            n = 0
+            for key in keys:
+                n += self._get(key) is not None
+                self._data.pop(key, None)
+                self._expire.pop(key, None)
+            return n
+
+    def exists(self, key):
+        with self._lock:
+            return int(self._get(key) is not None)
+
+    def expire(self, key, seconds):
+        with self._lock:
+            if self._get(key) is None:
+                return False
+            self._expire[key] = time.time() + seconds
+            return True
+
+    def incr(self, key, amount=1):
+        with self._lock:
+            value = int(self._get(key, b"0")) + amount
+            self._data[key] = self._b(value)
+            return value
+
+    def keys(self, pattern="*"):
+        with self._lock:
+            return [k.encode() for k in list(self._data) if self._get(k) is not None
+                    and fnmatch.fnmatchcase(k, pattern)]
+
+    def rpush(self, key, *values):
+        with self._lock:
+            lst = self._get(key)
+            if lst is None:
+                lst = self._data[key] = []
+            lst.extend(self._b(v) for v in values)
+            return len(lst)
+
+    def blpop(self, keys, timeout=0):
+        # 轮询实现阻塞读取，timeout 为 0 时一直等待
+        deadline = time.time() + timeout if timeout else None
+        while True:
+            with self._lock:
+                for key in keys:
+                    lst = self._get(key)
+                    if lst:
+                        return key.encode(), lst.pop(0)
+            if deadline is not None and time.time() >= deadline:
+                return None
+            time.sleep(0.005)
+
+    def lrange(self, key, start, end):
+        with self._lock:
+            lst = self._get(key, [])
+            end = len(lst) if end == -1 else end + 1
+            return list(lst[start:end])
+
+    def lindex(self, key, index):
+        with self._lock:
+            lst = self._get(key, [])
+            return lst[index] if -len(lst) <= index < len(lst) else None
+
+    def hset(self, key, field=None, value=None, mapping=None):
+        with self._lock:
+            h = self._get(key)
+            if h is None:
+                h = self._data[key] = {}
+            items = dict(mapping or {})
+            if field is not None:
+                items[field] = value
+            for k, v in items.items():
+                h[self._b(k)] = self._b(v)
+            return len(items)
+
+    def hget(self, key, field):
+        with self._lock:
+            return self._get(key, {}).get(self._b(field))
+
+    def hgetall(self, key):
+        with self._lock:
+            return dict(self._get(key, {}))
+
+    def hmget(self, key, fields):
+        with self._lock:
+            h = self._get(key, {})
+            return [h.get(self._b(f)) for f in fields]
+
+    def hdel(self, key, *fields):
+        with self._lock:
+            h = self._get(key, {})
+            return sum(h.pop(self._b(f), None) is not None for f in fields)
+
+    def zadd(self, key, mapping):
+        with self._lock:
+            z = self._get(key)
+            if z is None:
+                z = self._data[key] = {}
+            for member, score in mapping.items():
+                z[self._b(member)] = float(score)
+            return len(mapping)
+
+    def zrem(self, key, *members):
+        with self._lock:
+            z = self._get(key, {})
+            return sum(z.pop(self._b(m), None) is not None for m in members)
+
+    def zrangebyscore(self, key, lo, hi):
+        with self._lock:
+            hi = float("inf") if hi == "+inf" else float(hi)
+            return [m for s, m in sorted((s, m) for m, s in self._get(key, {}).items() if float(lo) <= s <= hi)]
+
+    def zremrangebyscore(self, key, lo, hi):
+        with self._lock:
+            z = self._get(key, {})
+            drop = [m for m, s in z.items() if float(lo) <= s <= float(hi)]
+            for m in drop:
+                del z[m]
+            return len(drop)
+
+    def zrevrangebyscore(self, key, hi, lo, start=None, num=None):
+        with self._lock:
+            hi = float("inf") if hi == "+inf" else float(hi)
+            lo = float("-inf") if lo == "-inf" else float(lo)
+            items = sorted(((s, m) for m, s in self._get(key, {}).items() if lo <= s <= hi), reverse=True)
+            members = [m for _, m in items]
+            if start is not None:
+                members = members[start:start + num]
+            return members
+
+    def pipeline(self):
+        return _Pipeline(self)
+
+
+class _Pipeline:
+    def __init__(self, client):
+        self._client = client
+        self._calls = []
+
+    def __getattr__(self, name):
+        def call(*args, **kwargs):
+            self._calls.append((name, args, kwargs))
+            return self
+        return call
+
+    def execute(self):
+        with self._client._lock:
+            out = [getattr(self._client, name)(*args, **kwargs) for name, args, kwargs in self._calls]
+        self._calls = []
+        return out
+
+
+# 必须在导入其他后端模块之前替换，它们都通过 `from settings import r` 取得客户端
+settings.r = MemoryRedis()
+
+import flaskApp  # noqa: E402
+import worker  # noqa: E402
+from janitor import Janitor  # noqa: E402
+from metrics import TrainMetrics  # noqa: E402
+from procinfo import rss_mb  # noqa: E402
+from settings import OUTPUT_DIR  # noqa: E402
+
+
+def _synthetic_masks(shape, n_cells: int, rng) -> np.ndarray:
+    """
+    在给定尺寸上随机放置圆形细胞，返回 uint16 标签图。
+    """
+    h, w = shape
+    masks = np.zeros((h, w), np.uint16)
+    yy, xx = np.ogrid[:h, :w]
+    radius = max(2, min(h, w) // 40)
+    for label in range(1, n_cells + 1):
+        cy, cx = rng.integers(0, h), rng.integers(0, w)
+        r = radius * rng.uniform(0.6, 1.4)
+        masks[(yy - cy) ** 2 + (xx - cx) ** 2 <= r * r] = label
+    return masks
+
+
+class FakeCprun:
+    """
+    替代 Cprun 的假分割引擎：每张图片等待 latency 秒（±jitter 比例），
+    输出与真实引擎同名的合成掩膜 tif 与叠加图 png。
+    """
+
+    latency = 0.2
+    jitter = 0.2
+    n_cells = 40
+
+    @classmethod
+    def _sleep(cls, seconds: float):
+        time.sleep(max(0., seconds * (1 + random.uniform(-cls.jitter, cls.jitter))))
+
+    @classmethod
+    async def run(cls, images=None, time=None, model="cpsam", diameter=None,
+                  flow_threshold=0.4, cellprob_threshold=0.0, auto_diameter=False):
+        if time is None:
+            return [False, "No time received"]
+        images = [images] if isinstance(images, str) else list(images or [])
+        outdir = Path(OUTPUT_DIR) / time
+        outdir.mkdir(parents=True, exist_ok=True)
+        rng = np.random.default_rng()
+        for name in images:
+            # 模拟计算占用工作线程
+            cls._sleep(cls.latency)
+            with Image.open(name) as im:
+                img = np.asarray(im.convert("L"))
+            masks = _synthetic_masks(img.shape, cls.n_cells, rng)
+            stem = Path(name).stem
+            Image.fromarray(masks).save(outdir / f"{stem}_output_cp_masks.tif")
+            over = np.stack([img] * 3, axis=-1)
+            over[masks > 0] = (over[masks > 0] * 0.5 + np.array([255, 64, 64]) * 0.5).astype(np.uint8)
+            Image.fromarray(over).save(outdir / f"{stem}_overlay.png")
+        return [True, [f"Using {model} model", f"Output saved to: {outdir}"], {}]
+
+
+class FakeCptrain:
+    """
+    替代 Cptrain 的假训练引擎：每个 epoch 等待 epoch_latency 秒并写入合成的逐 epoch 指标。
+    """
+
+    epoch_latency = 0.05
+
+    @classmethod
+    async def start_train(cls, time=None, n_epochs=100, learning_rate=5e-5, test_every=10, **kwargs):
+        n_epochs = max(1, int(n_epochs))
+        TrainMetrics.clear(time)
+        train_losses, test_losses = np.zeros(n_epochs), np.zeros(n_epochs)
+        for iepoch in range(n_epochs):
+            FakeCprun._sleep(cls.epoch_latency)
+            train_losses[iepoch] = 1.0 / (1 + iepoch) + 0.1
+            if iepoch == 5 or iepoch % test_every == 0:
+                test_losses[iepoch] = train_losses[iepoch] + 0.05
+            TrainMetrics.append(time, iepoch, train_loss=train_losses[iepoch],
+                                test_loss=test_losses[iepoch] or None, lr=learning_rate,
+                                step_time=cls.epoch_latency, peak_mem_mb=rss_mb())
+        history = {"step_time": np.full(n_epochs, cls.epoch_latency), "best_epoch": None,
+                   "best_test_loss": None, "stopped_epoch": None, "stop_reason": None}
+        return train_losses, test_losses, history
+
+
+class LoadTest:
+    """
+    依次对每个接口施加并发负载，记录每个请求的延迟与结果。
+    """
+
+    def __init__(self, concurrency: int, requests: int, image_size: int, n_epochs: int):
+        self.concurrency = concurrency
+        self.requests = requests
+        self.n_epochs = n_epochs
+        self.run_ids, self.train_ids = [], []
+        self._ids_lock = threading.Lock()
+        self._local = threading.local()
+
+        rng = np.random.default_rng(0)
+        img = rng.integers(0, 255, (image_size, image_size), dtype=np.uint8)
+        self.image = self._png(img)
+        self.mask = self._png(_synthetic_masks(img.shape, 20, rng).astype(np.uint8))
+
+    @staticmethod
+    def _png(arr) -> bytes:
+        buf = io.BytesIO()
+        Image.fromarray(arr).save(buf, format="PNG")
+        return buf.getvalue()
+
+    @property
+    def client(self):
+        # test_client 不是线程安全的，每个压测线程各自持有一个
+        if not hasattr(self._local, "client"):
+            self._local.client = flaskApp.app.test_client()
+        return self._local.client
+
+    # 各接口的单次请求，返回响应
+    def run_upload(self, i):
+        resp = self.client.post("/run_upload", data={"files": (io.BytesIO(self.image), f"img{i}.png")},
+                                content_type="multipart/form-data")
+        if resp.status_code == 200:
+            with self._ids_lock:
+                self.run_ids.append(resp.get_json()["id"])
+        return resp
+
+    def status(self, i):
+        return self.client.get(f"/status?id={self.run_ids[i % len(self.run_ids)]}")
+
+    def preview(self, i):
+        return self.client.get(f"/preview?id={self.run_ids[i % len(self.run_ids)]}")
+
+    def dl(self, i):
+        resp = self.client.get(f"/dl?id={self.run_ids[i % len(self.run_ids)]}")
+        resp.close()
+        return resp
+
+    def train_upload(self, i):
+        data = {"train_files": [(io.BytesIO(self.image), f"t{i}_img.png"),
+                                (io.BytesIO(self.mask), f"t{i}_masks.png")],
+                "test_files": [(io.BytesIO(self.image), f"v{i}_img.png"),
+                               (io.BytesIO(self.mask), f"v{i}_masks.png")]}
+        resp = self.client.post(f"/train_upload?n_epochs={self.n_epochs}", data=data,
+                                content_type="multipart/form-data")
+        if resp.status_code == 200:
+            with self._ids_lock:
+                self.train_ids.append(resp.get_json()["id"])
+        return resp
+
+    def phase(self, endpoint: str, drain: list[str] | None = None) -> dict:
+        """
+        以 concurrency 个线程共发出 requests 个请求。
+
+        :param drain: 阶段结束前等待这些任务完成（计入内存增长，不计入延迟）
+        """
+        fn = getattr(self, endpoint)
+        latencies, errors, rejected = [], 0, 0
+        lock = threading.Lock()
+
+        def one(i):
+            nonlocal errors, rejected
+            t0 = time.perf_counter()
+            try:
+                code = fn(i).status_code
+            except Exception:
+                code = 500
+            dt = time.perf_counter() - t0
+            with lock:
+                latencies.append(dt)
+                # 429 为准入控制的正常拒绝，单独统计
+                rejected += code == 429
+                errors += code >= 400 and code != 429
+
+        gc.collect()
+        rss0 = rss_mb()
+        t0 = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=self.concurrency) as pool:
+            list(pool.map(one, range(self.requests)))
+        wall = time.perf_counter() - t0
+        if drain is not None:
+            self.wait(drain)
+        gc.collect()
+
+        ms = np.array(latencies) * 1000
+        return {
+            "requests": len(latencies),
+            "errors": errors,
+            "rejected": rejected,
+            "p50_ms": float(np.percentile(ms, 50)),
+            "p95_ms": float(np.percentile(ms, 95)),
+            "p99_ms": float(np.percentile(ms, 99)),
+            "mean_ms": statistics.fmean(ms),
+            "throughput_rps": len(latencies) / wall,
+            "rss_growth_mb": rss_mb() - rss0,
+        }
+
+    @staticmethod
+    def wait(task_ids: list[str], timeout: float = 600):
+        """
+        等待后台任务结束。
+        """
+        deadline = time.time() + timeout
+        pending = list(task_ids)
+        while pending and time.time() < deadline:
+            pending = [t for t in pending
+                       if (flaskApp.get_status(t) or {}).get("status") in ("pending", "running", "done")]
+            time.sleep(0.05)
+        return not pending
+
+    def cleanup(self):
+        for task_id in self.run_ids + self.train_ids:
+            for dirs in Janitor.artifact_classes().values():
+                for d in dirs:
+                    shutil.rmtree(d / task_id, ignore_errors=True)
+            (Path(OUTPUT_DIR) / "tmp" / f"{task_id}.zip").unlink(missing_ok=True)
+
+    def run(self) -> dict:
+        results = {}
+        # run_upload 阶段不等待任务完成，让 /status 在任务执行期间轮询
+        results["run_upload"] = self.phase("run_upload")
+        results["status"] = self.phase("status", drain=self.run_ids)
+        results["preview"] = self.phase("preview")
+        results["dl"] = self.phase("dl")
+        results["train_upload"] = self.phase("train_upload", drain=self.train_ids)
+        return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--concurrency", type=int, default=16, help="并发请求线程数")
+    parser.add_argument("--requests", type=int, default=200, help="每个接口的请求数")
+    parser.add_argument("--latency", type=float, default=0.2, help="假分割引擎每张图片的耗时（秒）")
+    parser.add_argument("--jitter", type=float, default=0.2, help="耗时的随机浮动比例")
+    parser.add_argument("--epoch-latency", type=float, default=0.05, help="假训练引擎每个 epoch 的耗时（秒）")
+    parser.add_argument("--epochs", type=int, default=5, help="每个训练任务的 epoch 数")
+    parser.add_argument("--image-size", type=int, default=512, help="上传图片的边长")
+    parser.add_argument("--cells", type=int, default=40, help="合成掩膜中的细胞数")
+    parser.add_argument("--json", action="store_true", help="以 JSON 输出结果")
+    parser.add_argument("--keep", action="store_true", help="保留压测产生的任务目录")
+    parser.add_argument("--verbose", action="store_true", help="不屏蔽接口中的 print 输出")
+    args = parser.parse_args()
+
+    FakeCprun.latency, FakeCprun.jitter, FakeCprun.n_cells = args.latency, args.jitter, args.cells
+    FakeCptrain.epoch_latency = args.epoch_latency
+    worker.ENGINES.update(run=FakeCprun, train=FakeCptrain)
+    # 计算进程在本进程的线程中运行，与 web 进程共用内存 redis
+    runner = worker.JobRunner()
+    runner.start()
+
+    test = LoadTest(args.concurrency, args.requests, args.image_size, args.epochs)
+    quiet = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(io.StringIO())
+    try:
+        with quiet:
+            results = test.run()
+    finally:
+        runner.stop()
+        if not args.keep:
+            test.cleanup()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"concurrency={args.concurrency}, requests/endpoint={args.requests}, "
+          f"latency={args.latency}s/image, compute workers={runner.workers}")
+    print(f"{'endpoint':<14}{'n':>6}{'err':>6}{'429':>6}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'req/s':>10}{'+RSS MB':>10}")
+    for name, res in results.items():
+        print(f"{name:<14}{res['requests']:>6}{res['errors']:>6}{res['rejected']:>6}{res['p50_ms']:>10.1f}{res['p95_ms']:>10.1f}"
+              f"{res['p99_ms']:>10.1f}{res['throughput_rps']:>10.1f}{res['rss_growth_mb']:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,10 +1,18 @@
-from cp_run import Cprun
-from flaskApp import run_dev
+from flaskApp import cfg, run_dev, run_prod
+from worker import run_worker
 from multiprocessing import Process
 
 
 if __name__ == "__main__":
     # Cprun.run_test()
-    p = Process(target=run_dev)
-    p.start()
-    print(f"Flask running in PID {p.pid}")
\ No newline at end of file
+    # 分割 / 训练任务在独立的计算进程中执行，web 进程只负责入队
+    worker = Process(target=run_worker, name="cellpose-worker")
+    worker.start()
+    print(f"Compute worker running in PID {worker.pid}")
+    if cfg.backend.get("server", "dev") == "prod":
+        # gunicorn 自己管理 worker 进程与信号，直接在主进程中运行
+        run_prod()
+    else:
+        p = Process(target=run_dev)
+        p.start()
+        print(f"Flask running in PID {p.pid}")
@@ -0,0 +1,78 @@
+import math
+
+import numpy as np
+
+from settings import r
+
+TASK_TTL = 86400  # 与任务状态一致，1 天过期
+FIELDS = ("epoch", "train_loss", "test_loss", "lr", "step_time", "peak_mem_mb")
+_RECORD = np.dtype([(name, "<f4") for name in FIELDS])
+
+
+class TrainMetrics:
+    """
+    训练过程的逐 epoch 指标。
+
+    每个 epoch 结束时向 redis 列表 task:{id}:metrics 追加一条记录，记录为按 FIELDS 顺序打包的
+    float32（24 字节），未计算的值（如非测试 epoch 的 test_loss）记为 NaN。列表下标即 epoch，
+    读取新数据只需 LRANGE 尾部，任务状态中不再保存完整的损失数组。
+    """
+
+    @staticmethod
+    def key(task_id: str) -> str:
+        return f"task:{task_id}:metrics"
+
+    @classmethod
+    def append(cls, task_id: str, epoch: int, **values):
+        """
+        追加一个 epoch 的指标。
+
+        :param task_id: 任务 ID
+        :param epoch: 从 0 开始的 epoch 序号
+        :param values: FIELDS 中的其余字段，缺省为 NaN
+        """
+        rec = np.full(1, np.nan, dtype=_RECORD)
+        rec["epoch"] = epoch
+        for name, value in values.items():
+            if value is not None:
+                rec[name] = value
+        pipe = r.pipeline()
+        pipe.rpush(cls.key(task_id), rec.tobytes())
+        pipe.expire(cls.key(task_id), TASK_TTL)
+        # 训练期间任务状态只在开始和结束时写入，逐 epoch 续期，长于 1 天的训练不会在 /train_metrics 中消失
+        pipe.expire(f"task:{task_id}", TASK_TTL)
+        pipe.execute()
+
+    @classmethod
+    def read(cls, task_id: str, since: int = 0) -> dict[str, list]:
+        """
+        读取从第 since 个 epoch 开始的指标。
+
+        :return: 按字段分列的数据，NaN 以 None 表示
+        """
+        raw = r.lrange(cls.key(task_id), max(0, since), -1)
+        recs = np.frombuffer(b"".join(raw), dtype=_RECORD)
+        columns = {}
+        for name in FIELDS:
+            col = recs[name].tolist()
+            columns[name] = [int(x) for x in col] if name == "epoch" else \
+                [None if math.isnan(x) else x for x in col]
+        return columns
+
+    @classmethod
+    def clear(cls, task_id: str):
+        r.delete(cls.key(task_id))
+
+    @staticmethod
+    def summary(train_losses, test_losses, history: dict) -> dict:
+        """
+        训练结束后写入任务状态的标量摘要；逐 epoch 的数据通过 /train_metrics 获取。
+        """
+        tested = [float(x) for x in test_losses if x]
+        out = {
+            "epochs": len(train_losses),
+            "final_train_loss": float(train_losses[-1]) if len(train_losses) else None,
+            "final_test_loss": tested[-1] if tested else None,
+        }
+        out.update({k: v for k, v in history.items() if not isinstance(v, (list, np.ndarray))})
+        return out
@@ -0,0 +1,153 @@
+import datetime
+import hashlib
+import json
+import os
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+
+from settings import r, MODELS_DIR
+
+INDEX_PATH = Path(MODELS_DIR) / ".index.json"
+VERSION_KEY = "models:index:version"
+LOCK_KEY = "models:index:lock"
+
+
+@contextmanager
+def _index_lock(timeout: int = 30):
+    """
+    跨进程互斥写索引（redis SET NX）。
+    """
+    token = uuid.uuid4().hex
+    deadline = time.time() + timeout
+    while not r.set(LOCK_KEY, token, nx=True, ex=timeout):
+        if time.time() > deadline:
+            raise TimeoutError("model index is locked")
+        time.sleep(0.05)
+    try:
+        yield
+    finally:
+        if r.get(LOCK_KEY) == token.encode():
+            r.delete(LOCK_KEY)
+
+
+class ModelRegistry:
+    """
+    模型索引，以 JSON 文件保存在模型目录中。
+
+    训练完成时写入索引并递增 redis 中的版本号；各 web 进程在内存中缓存索引，
+    只有版本号变化时才重新读取文件。cellpose 自行下载到模型目录的基础模型不经过 register，
+    因此同时记录目录的修改时间，变化时对比文件列表，发现新模型再重建索引。
+    """
+
+    _lock = threading.Lock()
+    _cache = None
+    _version = None
+    _mtime = None
+    _etag = None
+
+    @staticmethod
+    def _read() -> dict:
+        try:
+            with open(INDEX_PATH, encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    @staticmethod
+    def _write(index: dict):
+        # 先写临时文件再替换，读者不会看到写了一半的索引
+        tmp = INDEX_PATH.with_suffix(f".{os.getpid()}.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(index, f, ensure_ascii=False, indent=2)
+        os.replace(tmp, INDEX_PATH)
+        r.incr(VERSION_KEY)
+
+    @staticmethod
+    def _file_entry(path: Path) -> dict:
+        st = path.stat()
+        return {
+            "name": path.name,
+            "size": st.st_size,
+            "created_at": datetime.datetime.utcfromtimestamp(st.st_mtime).isoformat(),
+        }
+
+    @staticmethod
+    def _on_disk() -> dict[str, Path]:
+        return {p.name: p for p in Path(MODELS_DIR).iterdir()
+                if p.is_file() and not p.name.startswith(".")}
+
+    @classmethod
+    def rebuild(cls) -> dict:
+        """
+        扫描模型目录，补充索引中缺失的模型并移除已不存在的模型。
+        """
+        with _index_lock():
+            index = cls._read()
+            on_disk = cls._on_disk()
+            index = {name: entry for name, entry in index.items() if name in on_disk}
+            for name, path in on_disk.items():
+                if name not in index:
+                    index[name] = cls._file_entry(path)
+            cls._write(index)
+        return index
+
+    @classmethod
+    def register(cls,
+                 model_path: str | Path,
+                 base_model: str | None = None,
+                 train_losses=None,
+                 test_losses=None,
+                 params: dict | None = None):
+        """
+        记录一次训练保存的模型。
+
+        :param model_path: train_seg 返回的模型文件路径
+        :param base_model: 训练所基于的模型
+        :param train_losses: 每个 epoch 的训练损失
+        :param test_losses: 每个 epoch 的测试损失（未测试的 epoch 为 0）
+        :param params: 训练参数
+        :return:
+        """
+        path = Path(model_path)
+        entry = cls._file_entry(path)
+        train_losses = list(train_losses) if train_losses is not None else []
+        # 测试损失只在部分 epoch 计算，取最后一个非零值
+        tested = [float(x) for x in (test_losses if test_losses is not None else []) if x]
+        entry.update({
+            "base_model": base_model,
+            "final_train_loss": float(train_losses[-1]) if len(train_losses) else None,
+            "final_test_loss": tested[-1] if tested else None,
+            "params": params or {},
+        })
+        with _index_lock():
+            index = cls._read()
+            index[path.name] = entry
+            cls._write(index)
+
+    @classmethod
+    def get(cls) -> tuple[list[dict], str]:
+        """
+        返回模型列表及对应的 ETag。
+        """
+        version = r.get(VERSION_KEY)
+        if version is None:
+            r.set(VERSION_KEY, 0, nx=True)
+            version = r.get(VERSION_KEY)
+        # 写索引本身也会改变目录的修改时间，所以时间变化后还要对比文件列表
+        mtime = os.stat(MODELS_DIR).st_mtime_ns
+        with cls._lock:
+            if cls._cache is not None and version == cls._version and mtime == cls._mtime:
+                return cls._cache, cls._etag
+            index = cls._read() if INDEX_PATH.exists() else None
+            if index is None or set(index) != set(cls._on_disk()):
+                index = cls.rebuild()
+            models = sorted(index.values(), key=lambda x: x["name"])
+            cls._cache = models
+            # 记录读取前的版本号：读取期间若有其他进程写入，下次请求会发现版本变化并重新读取
+            cls._version = version
+            cls._mtime = mtime
+            cls._etag = hashlib.sha1(json.dumps(models, sort_keys=True).encode()).hexdigest()
+            return cls._cache, cls._etag
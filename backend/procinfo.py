@@ -0,0 +1,49 @@
+"""
+本进程与本机的内存信息，读取 Linux 的 /proc；没有 /proc 时退化为 getrusage 的峰值 RSS。
+
+只依赖标准库，启动基准（bench_startup.py）在测量前导入它，不影响测量结果。
+"""
+import sys
+
+
+def _read_mb(path: str, field: str) -> float | None:
+    try:
+        with open(path) as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+
+def max_rss_mb() -> float:
+    """
+    进程生命周期内的峰值 RSS（MB），来自 getrusage。
+    """
+    import resource
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / 1024 ** 2 if sys.platform == "darwin" else rss / 1024
+
+
+def rss_mb() -> float:
+    """
+    当前 RSS（MB），即 /proc/self/status 中的 VmRSS。
+    """
+    mem = _read_mb("/proc/self/status", "VmRSS")
+    return mem if mem is not None else max_rss_mb()
+
+
+def peak_rss_mb() -> float:
+    """
+    峰值 RSS（MB），即 VmHWM；向 /proc/self/clear_refs 写入 "5" 可将其重置为当前 RSS。
+    """
+    mem = _read_mb("/proc/self/status", "VmHWM")
+    return mem if mem is not None else max_rss_mb()
+
+
+def mem_available_mb() -> float | None:
+    """
+    本机可用内存（MB），即 /proc/meminfo 中的 MemAvailable；读不到时为 None。
+    """
+    return _read_mb("/proc/meminfo", "MemAvailable")
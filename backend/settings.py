@@ -0,0 +1,24 @@
+import os
+import redis
+from omegaconf import OmegaConf
+from pathlib import Path
+
+# 只依赖轻量模块，供 web 进程与计算进程共享配置
+CONFIG_PATH = Path(__file__).parent / "config.yaml"
+cfg = OmegaConf.load(CONFIG_PATH)
+cfg.data.root_dir = str((CONFIG_PATH.parent / cfg.data.root_dir).resolve())
+BASE_DIR = cfg.data.root_dir
+UPLOAD_DIR = cfg.data.upload_dir
+OUTPUT_DIR = cfg.data.run.output_dir
+OUTPUT_TEST_DIR = cfg.data.run.test_output_dir
+CACHE_DIR = cfg.data.run.get("cache_dir", f"{BASE_DIR}/run/cache")
+FLOWS_DIR = cfg.data.run.get("flows_dir", f"{BASE_DIR}/run/flows")
+MODELS_DIR = str((CONFIG_PATH.parent / cfg.model.save_dir).resolve())
+TRAIN_DIR = cfg.data.train.train_dir
+TEST_DIR = cfg.data.train.test_dir
+
+# cellpose 在导入时读取该变量，必须在任何 cellpose 导入之前设置
+os.makedirs(MODELS_DIR, exist_ok=True)
+os.environ["CELLPOSE_LOCAL_MODELS_PATH"] = MODELS_DIR
+
+r = redis.Redis(host=cfg.redis.host, port=int(cfg.redis.port), db=int(cfg.redis.db))
@@ -0,0 +1,104 @@
+import datetime
+import json
+import os
+import shutil
+import time
+import uuid
+from pathlib import Path
+
+from settings import r
+
+TASK_TTL = 86400  # 与任务状态一致，1 天过期
+INDEX_KEY = "tasks:index"
+
+
+def set_status(task_id, status, **extra):
+    payload = {"status": status, "updated_at": datetime.datetime.utcnow().isoformat(), **extra}
+    r.set(f"task:{task_id}", json.dumps(payload), ex=TASK_TTL)
+
+def get_status(task_id):
+    raw = r.get(f"task:{task_id}")
+    return json.loads(raw) if raw else None
+
+
+class TaskRegistry:
+    """
+    任务创建与索引。
+
+    任务 ID 由时间前缀加随机后缀组成，按字典序即按时间排序；通过 redis SET NX 原子地占用
+    task:{id}，保证并发请求不会拿到同一个 ID、写入同一个目录。所有任务按创建时间记录在有序集合中，
+    列出最近任务时无需扫描目录。
+    """
+
+    @staticmethod
+    def new_id() -> str:
+        now = datetime.datetime.now()
+        return now.strftime("%Y-%m-%d-%H-%M-%S") + f"-{now.microsecond // 1000:03d}-{uuid.uuid4().hex[:8]}"
+
+    @classmethod
+    def create(cls, kind: str, dirs: list[str | Path] = (), status: str = "pending", **extra) -> str:
+        """
+        新建任务：占用状态键、创建任务目录并写入时间索引。
+
+        :param kind: 任务类型，如 run / train / batch
+        :param dirs: 需要为该任务创建子目录的父目录
+        :param status: 初始状态
+        :return: 任务 ID
+        """
+        for _ in range(8):
+            task_id = cls.new_id()
+            now = time.time()
+            payload = {"status": status, "updated_at": datetime.datetime.utcnow().isoformat(), **extra}
+            if not r.set(f"task:{task_id}", json.dumps(payload), nx=True, ex=TASK_TTL):
+                continue
+
+            created = []
+            try:
+                for d in dirs:
+                    p = Path(d) / task_id
+                    os.makedirs(p)  # 目录已存在说明 ID 冲突，换一个
+                    created.append(p)
+            except FileExistsError:
+                for p in created:
+                    shutil.rmtree(p, ignore_errors=True)
+                r.delete(f"task:{task_id}")
+                continue
+
+            meta = {"id": task_id, "kind": kind, "created_at": now}
+            pipe = r.pipeline()
+            pipe.set(f"task:{task_id}:meta", json.dumps(meta), ex=TASK_TTL)
+            pipe.zadd(INDEX_KEY, {task_id: now})
+            pipe.zremrangebyscore(INDEX_KEY, 0, now - TASK_TTL)
+            pipe.execute()
+            return task_id
+
+        raise RuntimeError("could not allocate a unique task id")
+
+    @classmethod
+    def recent(cls, limit: int = 20, kind: str | None = None) -> list[dict]:
+        """
+        按创建时间倒序列出最近的任务。
+        """
+        now = time.time()
+        tasks = []
+        offset = 0
+        page = max(limit, 20)
+        while len(tasks) < limit:
+            ids = r.zrevrangebyscore(INDEX_KEY, "+inf", now - TASK_TTL, start=offset, num=page)
+            if not ids:
+                break
+            offset += len(ids)
+            pipe = r.pipeline()
+            for task_id in ids:
+                pipe.get(f"task:{task_id.decode()}:meta")
+                pipe.get(f"task:{task_id.decode()}")
+            raw = pipe.execute()
+            for task_id, meta, st in zip(ids, raw[::2], raw[1::2]):
+                meta = json.loads(meta) if meta else {"id": task_id.decode(), "kind": None}
+                if kind is not None and meta.get("kind") != kind:
+                    continue
+                st = json.loads(st) if st else {}
+                tasks.append({**meta, "status": st.get("status"), "updated_at": st.get("updated_at")})
+                if len(tasks) >= limit:
+                    break
+        return tasks
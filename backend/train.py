@@ -1,3 +1,4 @@
+import contextlib
 import time
 import os
 import numpy as np
@@ -5,15 +6,18 @@ from cellpose import io, utils, models, dynamics
 from cellpose.transforms import normalize_img, random_rotate_and_resize, convert_image
 from pathlib import Path
 import torch
+import torch.distributed as dist
 from torch import nn
+from torch.nn.parallel import DistributedDataParallel
 from tqdm import trange
-import redis
 import json
 import datetime
 
 import logging
 
-r = redis.Redis(host="127.0.0.1", port=6379, db=0)
+from metrics import TrainMetrics
+from procinfo import peak_rss_mb, rss_mb
+from settings import r
 
 def set_status(task_id, status, **extra):
     payload = {"status": status, "updated_at": datetime.datetime.utcnow().isoformat(), **extra}
@@ -325,6 +329,125 @@ def _process_train_test(train_data=None, train_labels=None, train_files=None,
             test_probs, diam_test, normed)
 
 
+def _enable_activation_checkpointing(net):
+    """
+    Recompute the activations of each transformer block during the backward pass
+    instead of storing them, trading compute for memory.
+
+    Args:
+        net (torch.nn.Module): The network; every ``blocks`` ModuleList inside it is wrapped.
+
+    Returns:
+        list: The wrapped blocks, to pass to _disable_activation_checkpointing.
+    """
+    from torch.utils.checkpoint import checkpoint
+
+    wrapped = []
+    for module in net.modules():
+        blocks = getattr(module, "blocks", None)
+        if not isinstance(blocks, nn.ModuleList):
+            continue
+        for block in blocks:
+            def forward(*args, _forward=block.forward, **kwargs):
+                if torch.is_grad_enabled():
+                    return checkpoint(_forward, *args, use_reentrant=False, **kwargs)
+                return _forward(*args, **kwargs)
+            block.forward = forward
+            wrapped.append(block)
+    return wrapped
+
+
+def _disable_activation_checkpointing(blocks):
+    for block in blocks:
+        del block.forward
+
+
+def _reset_peak_mem(device):
+    """
+    Reset the peak memory counter read by _peak_mem_mb at the start of an epoch.
+
+    On GPU this resets the CUDA allocator statistics. On CPU it writes "5" to /proc/self/clear_refs,
+    which resets the process high-water mark (VmHWM) to the current RSS. Returns False when the
+    counter cannot be reset (no procfs, or clear_refs not writable).
+    """
+    if device.type == "cuda":
+        torch.cuda.reset_peak_memory_stats(device)
+        return True
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def _peak_mem_mb(device, reset=True):
+    """
+    Peak memory in MB since the last _reset_peak_mem.
+
+    On GPU this is the peak allocated CUDA memory. On CPU it is the process VmHWM, which only covers
+    the current epoch when _reset_peak_mem succeeded (reset=True); otherwise the lifetime peak would
+    be meaningless per epoch, so the current RSS (VmRSS) at the end of the epoch is reported instead.
+    CPU values are process-wide and include other jobs running in the same process.
+    """
+    if device.type == "cuda":
+        return torch.cuda.max_memory_allocated(device) / 1024 ** 2
+    return peak_rss_mb() if reset else rss_mb()
+
+
+def _all_reduce_sum(*values):
+    """
+    Sum scalars over all data-parallel ranks; returns them unchanged without a process group.
+    """
+    if not (dist.is_available() and dist.is_initialized()):
+        return values
+    t = torch.tensor(values, dtype=torch.float64)
+    dist.all_reduce(t, op=dist.ReduceOp.SUM)
+    return tuple(t.tolist())
+
+
+def _shard(rperm, rank, world_size):
+    """
+    Rank's share of the sample order. The order is padded by wrapping around so every rank
+    runs the same number of steps (collectives would otherwise hang on the last batch).
+    """
+    if world_size == 1:
+        return rperm
+    n = -(-len(rperm) // world_size) * world_size
+    return np.resize(rperm, n)[rank::world_size]
+
+
+LR_SCHEDULES = ("default", "cosine", "plateau")
+
+
+def _lr_schedule(schedule, learning_rate, n_epochs):
+    """
+    Per-epoch learning rates: a 10 epoch linear warm-up followed by
+
+    - "default": constant, then halved every 5 (n_epochs > 99) or 10 (n_epochs > 300) epochs at the end
+    - "cosine": cosine decay to zero over the remaining epochs
+    - "plateau": constant; train_seg scales it down whenever the test loss stops improving
+    """
+    if schedule not in LR_SCHEDULES:
+        raise ValueError(f"lr_schedule must be one of {LR_SCHEDULES}, got {schedule!r}")
+    LR = np.linspace(0, learning_rate, 10)
+    rest = max(0, n_epochs - 10)
+    if schedule == "cosine":
+        return np.append(LR, learning_rate * 0.5 * (1 + np.cos(np.pi * np.arange(rest) / max(rest, 1))))
+    LR = np.append(LR, learning_rate * np.ones(rest))
+    if schedule == "plateau":
+        return LR
+    if n_epochs > 300:
+        LR = LR[:-100]
+        for i in range(10):
+            LR = np.append(LR, LR[-1] / 2 * np.ones(10))
+    elif n_epochs > 99:
+        LR = LR[:-50]
+        for i in range(10):
+            LR = np.append(LR, LR[-1] / 2 * np.ones(5))
+    return LR
+
+
 def train_seg(net, train_data=None, train_labels=None, train_files=None,
               train_labels_files=None, train_probs=None, test_data=None,
               test_labels=None, test_files=None, test_labels_files=None,
@@ -333,7 +456,11 @@ def train_seg(net, train_data=None, train_labels=None, train_files=None,
               n_epochs=100, weight_decay=0.1, normalize=True, compute_flows=False,
               save_path=None, save_every=100, save_each=False, nimg_per_epoch=None,
               nimg_test_per_epoch=None, rescale=False, scale_range=None, bsize=256,
-              min_train_masks=5, model_name=None, class_weights=None, ts=None):
+              min_train_masks=5, model_name=None, class_weights=None, ts=None,
+              bf16=False, grad_accum_steps=1, activation_checkpointing=False,
+              rank=0, world_size=1, test_every=10, lr_schedule="default",
+              plateau_patience=20, plateau_factor=0.5, early_stopping_patience=0,
+              min_delta=0., restore_best=True):
     """
     Train the network with images for segmentation.
 
@@ -366,9 +493,27 @@ def train_seg(net, train_data=None, train_labels=None, train_files=None,
         rescale (bool, optional): Boolean - whether or not to rescale images during training. Defaults to True.
         min_train_masks (int, optional): Integer - minimum number of masks an image must have to use in the training set. Defaults to 5.
         model_name (str, optional): String - name of the network. Defaults to None.
+        bf16 (bool, optional): Boolean - run forward passes under bfloat16 autocast (CPU or GPU). Defaults to False.
+        grad_accum_steps (int, optional): Integer - split each batch into this many micro-batches and accumulate gradients before the optimizer step, so peak memory follows the micro-batch size. Defaults to 1.
+        activation_checkpointing (bool, optional): Boolean - recompute transformer block activations in the backward pass instead of storing them. Defaults to False.
+        rank (int, optional): Integer - rank of this process in the data-parallel group. Defaults to 0.
+        world_size (int, optional): Integer - number of data-parallel processes. When > 1 the default process group must already be initialized; each rank trains on its shard of the epoch's samples with batch_size patches per step, gradients are all-reduced, and only rank 0 logs and saves. Defaults to 1.
+        ts (str, optional): String - task id; when given, rank 0 appends each epoch's metrics to TrainMetrics as training progresses. Defaults to None.
+        test_every (int, optional): Integer - evaluate the test loss every [test_every] epochs (and at epoch 5). Defaults to 10.
+        lr_schedule (str, optional): String - "default" (warm-up then step halving), "cosine" or "plateau" (reduce when the test loss stops improving). Defaults to "default".
+        plateau_patience (int, optional): Integer - epochs without test loss improvement before the "plateau" schedule reduces the learning rate. Defaults to 20.
+        plateau_factor (float, optional): Float - factor applied to the learning rate on each plateau. Defaults to 0.5.
+        early_stopping_patience (int, optional): Integer - stop when the test loss has not improved for this many epochs; 0 disables early stopping. Defaults to 0.
+        min_delta (float, optional): Float - minimum decrease of the test loss that counts as an improvement. Defaults to 0.
+        restore_best (bool, optional): Boolean - with early stopping enabled, save the weights from the epoch with the best test loss instead of the last ones. Defaults to True.
 
     Returns:
-        tuple: A tuple containing the path to the saved model weights, training losses, and test losses.
+        tuple: A tuple containing the path to the saved model weights, training losses, test losses,
+            and a history dict with per-epoch "step_time" (mean seconds per optimizer step), "peak_mem_mb" and "lr",
+            where "peak_mem_mb" is the per-epoch CUDA peak on GPU and the per-epoch VmHWM on CPU (VmRSS at
+            the end of the epoch where /proc/self/clear_refs is unavailable),
+            plus "best_epoch", "best_test_loss", "stopped_epoch" and "stop_reason". Losses and per-epoch
+            histories are truncated to the epochs actually run.
 
     """
     if SGD:
@@ -417,16 +562,11 @@ def train_seg(net, train_data=None, train_labels=None, train_files=None,
     nimg_test_per_epoch = nimg_test if nimg_test_per_epoch is None else nimg_test_per_epoch
 
     # learning rate schedule
-    LR = np.linspace(0, learning_rate, 10)
-    LR = np.append(LR, learning_rate * np.ones(max(0, n_epochs - 10)))
-    if n_epochs > 300:
-        LR = LR[:-100]
-        for i in range(10):
-            LR = np.append(LR, LR[-1] / 2 * np.ones(10))
-    elif n_epochs > 99:
-        LR = LR[:-50]
-        for i in range(10):
-            LR = np.append(LR, LR[-1] / 2 * np.ones(5))
+    LR = _lr_schedule(lr_schedule, learning_rate, n_epochs)
+    has_test = test_data is not None or test_files is not None
+    if not has_test and (early_stopping_patience or lr_schedule == "plateau"):
+        train_logger.warning("no test data: early stopping and plateau schedule are disabled")
+        early_stopping_patience = 0
 
     train_logger.info(f">>> n_epochs={n_epochs}, n_train={nimg}, n_test={nimg_test}")
     train_logger.info(
@@ -443,8 +583,32 @@ def train_seg(net, train_data=None, train_labels=None, train_files=None,
 
     train_logger.info(f">>> saving model to {filename}")
 
+    grad_accum_steps = max(1, int(grad_accum_steps))
+    checkpointed = _enable_activation_checkpointing(net) if activation_checkpointing else []
+    train_logger.info(
+        f">>> bf16={bf16}, grad_accum_steps={grad_accum_steps}, checkpointed_blocks={len(checkpointed)}"
+    )
+
+    # data parallel: DDP broadcasts rank 0 weights on wrap and all-reduces gradients in backward
+    ddp = world_size > 1
+    # some parameters (e.g. unused heads) receive no gradient, let DDP skip them
+    model = DistributedDataParallel(net, find_unused_parameters=True) if ddp else net
+    if ddp:
+        train_logger.info(f">>> rank {rank}/{world_size}, torch threads={torch.get_num_threads()}")
+    if rank != 0:
+        train_logger.setLevel(logging.WARNING)
+    train_logger.info(
+        f">>> lr_schedule={lr_schedule}, early_stopping_patience={early_stopping_patience}, min_delta={min_delta}"
+    )
+
+    # test losses are all-reduced, so every rank takes the same stopping / LR decisions
+    best_loss, best_epoch, best_state = np.inf, -1, None
+    lr_scale, last_reduce = 1., 0
+    stop_reason = None
+
     lavg, nsum = 0, 0
     train_losses, test_losses = np.zeros(n_epochs), np.zeros(n_epochs)
+    step_times, peak_mem, lrs = np.zeros(n_epochs), np.zeros(n_epochs), np.zeros(n_epochs)
     for iepoch in range(n_epochs):
         np.random.seed(iepoch)
         if nimg != nimg_per_epoch:
@@ -454,11 +618,18 @@ def train_seg(net, train_data=None, train_labels=None, train_files=None,
         else:
             # otherwise use all images
             rperm = np.random.permutation(np.arange(0, nimg))
+        if ddp:
+            # same order on every rank, each takes its own slice; augmentations differ per rank
+            rperm = _shard(rperm, rank, world_size)
+            np.random.seed(iepoch * world_size + rank)
+        lrs[iepoch] = LR[iepoch] * lr_scale
         for param_group in optimizer.param_groups:
-            param_group["lr"] = LR[iepoch]  # set learning rate
+            param_group["lr"] = lrs[iepoch]  # set learning rate
+        peak_reset = _reset_peak_mem(device)
         net.train()
-        for k in range(0, nimg_per_epoch, batch_size):
-            kend = min(k + batch_size, nimg_per_epoch)
+        nsteps, tsteps, nseen = 0, 0., 0
+        for k in range(0, len(rperm), batch_size):
+            kend = min(k + batch_size, len(rperm))
             inds = rperm[k:kend]
             imgs, lbls = _get_batch(inds, data=train_data, labels=train_labels,
                                     files=train_files, labels_files=train_labels_files,
@@ -478,33 +649,55 @@ def train_seg(net, train_data=None, train_labels=None, train_files=None,
                 X = X.to(net.dtype)
                 lbl = lbl.to(net.dtype)
 
-            y = net(X)[0]
-            loss = _loss_fn_seg(lbl, y, device)
-            if y.shape[1] > 3:
-                loss3 = _loss_fn_class(lbl, y, class_weights=class_weights)
-                loss += loss3
+            tstep = time.time()
             optimizer.zero_grad()
-            loss.backward()
+            train_loss = 0.
+            # gradient accumulation: micro-batches share one optimizer step
+            n_micro = min(grad_accum_steps, len(X))
+            for i, (Xm, lblm) in enumerate(zip(torch.tensor_split(X, n_micro),
+                                                torch.tensor_split(lbl, n_micro))):
+                # under DDP only the last micro-batch all-reduces gradients
+                sync = not ddp or i == n_micro - 1
+                with contextlib.nullcontext() if sync else model.no_sync():
+                    with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=bf16):
+                        y = model(Xm)[0]
+                    # losses in full precision
+                    y = y.float() if bf16 else y
+                    loss = _loss_fn_seg(lblm.to(y.dtype), y, device)
+                    if y.shape[1] > 3:
+                        loss3 = _loss_fn_class(lblm, y, class_weights=class_weights)
+                        loss += loss3
+                    (loss * len(Xm) / len(X)).backward()
+                train_loss += loss.item() * len(Xm)
             optimizer.step()
-            train_loss = loss.item()
-            train_loss *= len(imgi)
+            tsteps += time.time() - tstep
+            nsteps += 1
 
             # keep track of average training loss across epochs
             lavg += train_loss
             nsum += len(imgi)
+            nseen += len(imgi)
             # per epoch training loss
             train_losses[iepoch] += train_loss
-        train_losses[iepoch] /= nimg_per_epoch
+        train_loss_sum, nseen = _all_reduce_sum(train_losses[iepoch], nseen)
+        train_losses[iepoch] = train_loss_sum / max(nseen, 1)
+        step_times[iepoch] = tsteps / max(nsteps, 1)
+        peak_mem[iepoch] = _peak_mem_mb(device, peak_reset)
 
-        if iepoch == 5 or iepoch % 10 == 0:
+        tested = False
+        if iepoch == 5 or iepoch % test_every == 0:
             lavgt = 0.
-            if test_data is not None or test_files is not None:
+            if has_test:
+                tested = True
                 np.random.seed(42)
                 if nimg_test != nimg_test_per_epoch:
                     rperm = np.random.choice(np.arange(0, nimg_test),
                                              size=(nimg_test_per_epoch,), p=test_probs)
                 else:
                     rperm = np.random.permutation(np.arange(0, nimg_test))
+                # every test sample is evaluated once, on one rank
+                ntest = len(rperm)
+                rperm = rperm[rank::world_size]
                 for ibatch in range(0, len(rperm), batch_size):
                     with torch.no_grad():
                         net.eval()
@@ -526,23 +719,50 @@ def train_seg(net, train_data=None, train_labels=None, train_files=None,
                             X = X.to(net.dtype)
                             lbl = lbl.to(net.dtype)
 
-                        y = net(X)[0]
-                        loss = _loss_fn_seg(lbl, y, device)
+                        with torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=bf16):
+                            y = net(X)[0]
+                        y = y.float() if bf16 else y
+                        loss = _loss_fn_seg(lbl.to(y.dtype), y, device)
                         if y.shape[1] > 3:
                             loss3 = _loss_fn_class(lbl, y, class_weights=class_weights)
                             loss += loss3
                         test_loss = loss.item()
                         test_loss *= len(imgi)
                         lavgt += test_loss
-                lavgt /= len(rperm)
+                lavgt, = _all_reduce_sum(lavgt)
+                lavgt /= ntest
                 test_losses[iepoch] = lavgt
+
+                if lavgt < best_loss - min_delta:
+                    best_loss, best_epoch, last_reduce = lavgt, iepoch, iepoch
+                    if early_stopping_patience and restore_best:
+                        best_state = {k: v.detach().clone() for k, v in net.state_dict().items()}
+                elif lr_schedule == "plateau" and iepoch - last_reduce >= plateau_patience:
+                    lr_scale *= plateau_factor
+                    last_reduce = iepoch
+                    train_logger.info(f"test loss plateaued, learning rate scaled to {lr_scale:g}x")
+                if early_stopping_patience and iepoch - best_epoch >= early_stopping_patience:
+                    stop_reason = (f"test loss did not improve by more than {min_delta:g} for "
+                                   f"{iepoch - best_epoch} epochs (best {best_loss:.4f} at epoch {best_epoch})")
+            lavg, nsum = _all_reduce_sum(lavg, nsum)
             lavg /= nsum
             train_logger.info(
-                f"{iepoch}, train_loss={lavg:.4f}, test_loss={lavgt:.4f}, LR={LR[iepoch]:.6f}, time {time.time() - t0:.2f}s"
+                f"{iepoch}, train_loss={lavg:.4f}, test_loss={lavgt:.4f}, LR={lrs[iepoch]:.6f}, "
+                f"step_time={step_times[iepoch]:.3f}s, peak_mem={peak_mem[iepoch]:.0f}MB, time {time.time() - t0:.2f}s"
             )
             lavg, nsum = 0, 0
 
-        if iepoch == n_epochs - 1 or (iepoch % save_every == 0 and iepoch != 0):
+        if ts is not None and rank == 0:
+            TrainMetrics.append(ts, iepoch, train_loss=train_losses[iepoch],
+                                test_loss=test_losses[iepoch] if tested else None,
+                                lr=lrs[iepoch], step_time=step_times[iepoch],
+                                peak_mem_mb=peak_mem[iepoch])
+
+        if stop_reason is not None:
+            train_logger.info(f"early stopping at epoch {iepoch}: {stop_reason}")
+            break
+
+        if rank == 0 and (iepoch == n_epochs - 1 or (iepoch % save_every == 0 and iepoch != 0)):
             if save_each and iepoch != n_epochs - 1:  # separate files as model progresses
                 filename0 = str(filename) + f"_epoch_{iepoch:04d}"
             else:
@@ -550,6 +770,21 @@ def train_seg(net, train_data=None, train_labels=None, train_files=None,
             train_logger.info(f"saving network parameters to {filename0}")
             net.save_model(filename0)
 
-    net.save_model(filename)
-
-    return filename, train_losses, test_losses
+    _disable_activation_checkpointing(checkpointed)
+    if best_state is not None:
+        train_logger.info(f"restoring weights from epoch {best_epoch} (test_loss={best_loss:.4f})")
+        net.load_state_dict(best_state)
+    if rank == 0:
+        net.save_model(filename)
+
+    n_run = iepoch + 1
+    history = {
+        "step_time": step_times[:n_run],
+        "peak_mem_mb": peak_mem[:n_run],
+        "lr": lrs[:n_run],
+        "best_epoch": best_epoch if best_epoch >= 0 else None,
+        "best_test_loss": float(best_loss) if best_epoch >= 0 else None,
+        "stopped_epoch": iepoch if stop_reason is not None else None,
+        "stop_reason": stop_reason,
+    }
+    return filename, train_losses[:n_run], test_losses[:n_run], history
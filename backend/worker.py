@@ -0,0 +1,257 @@
+"""
+计算进程：从 redis 队列中取出分割 / 训练任务并执行。
+
+web 进程（flaskApp）只负责入队，cellpose / torch 只在本进程中导入，且所有 web worker 共用同一份已加载的模型。
+收到 SIGTERM / SIGINT 后不再取新任务，等待正在执行的任务（包括训练）结束后退出；排队中的任务保留在 redis 中，
+下次启动时继续执行。
+
+用法::
+
+    python worker.py
+"""
+import asyncio
+import json
+import os
+import signal
+import socket
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from admission import Admission
+from jobs import JobQueue, LEASE_TTL, QUEUE_KEY, QUICK_QUEUE_KEY, RUNNING_KEY, REPLY_TTL
+from metrics import TrainMetrics
+from settings import cfg, r
+from tasks import TASK_TTL, set_status
+
+WORKER = cfg.get("worker", {})
+WORKERS = int(WORKER.get("workers", 4))
+QUICK_WORKERS = int(WORKER.get("quick_workers", 1))
+WARMUP = bool(cfg.backend.get("warmup", False))
+
+# 分割 / 训练引擎，首次使用时才导入 cellpose；压测（loadtest.py）时替换为假引擎
+ENGINES = {}
+
+def get_engine(kind: str):
+    """
+    :param kind: "run"（接口同 Cprun）或 "train"（接口同 Cptrain）
+    :return: 引擎类
+    """
+    if kind not in ENGINES:
+        if kind == "run":
+            from cp_run import Cprun
+            ENGINES[kind] = Cprun
+        else:
+            from cp_train import Cptrain
+            ENGINES[kind] = Cptrain
+    return ENGINES[kind]
+
+
+# 普通任务的处理函数：handler(task_id, params, extra)，extra 为每次写入状态时附带的字段，
+# 返回值合并到成功状态中
+def _run(ts, params, extra):
+    ok, message, *info = asyncio.run(get_engine("run").run(time=ts, **params))
+    return info[0] if info else {}
+
+def _stack(ts, params, extra):
+    def progress(done, total):
+        set_status(ts, "running", planes_done=done, planes_total=total, **extra)
+
+    ok, message, *info = asyncio.run(get_engine("run").run_stack(time=ts, progress=progress, **params))
+    if not ok:
+        raise RuntimeError(message)
+    return info[0] if info else {}
+
+def _resegment(ts, params, extra):
+    ok, message, *info = asyncio.run(get_engine("run").resegment(time=ts, **params))
+    if not ok:
+        raise RuntimeError(message)
+    return info[0] if info else {}
+
+def _batch(ts, params, extra):
+    files_key = f"task:{ts}:files"
+
+    def progress(name, ok, error):
+        extra["done" if ok else "failed"] += 1
+        r.hset(files_key, name, json.dumps({"status": "done" if ok else "failed", "error": error}))
+        r.expire(files_key, TASK_TTL)
+        JobQueue.renew(ts)
+        set_status(ts, "running", current=name, **extra)
+
+    ok, message, *info = asyncio.run(get_engine("run").run_batch(time=ts, progress=progress, **params))
+    if not ok:
+        raise RuntimeError(message)
+    return info[0] if info else {}
+
+def _train(ts, params, extra):
+    train_losses, test_losses, history = asyncio.run(get_engine("train").start_train(time=ts, **params))
+    return TrainMetrics.summary(train_losses, test_losses, history)
+
+HANDLERS = {"run": _run, "stack": _stack, "resegment": _resegment, "batch": _batch, "train": _train}
+
+
+# 快速任务的处理函数：handler(params)，返回值经 redis 回传给等待中的 web 请求
+def _quicklook(params):
+    params = dict(params)
+    path = params.pop("upload", None)
+    data = None
+    if path:
+        with open(path, "rb") as f:
+            data = f.read()
+    return get_engine("run").quicklook(data=data, **params)
+
+QUICK_HANDLERS = {"quicklook": _quicklook}
+
+
+class JobRunner:
+    """
+    执行队列中的任务。
+
+    普通任务与快速预览各用一个线程池，分别从各自的队列取任务，线程池有空闲时才取，未取出的任务留在 redis 中。
+    执行中的任务记录在 jobs:running 中并按心跳续约；心跳线程同时检查其他计算进程留下的记录，
+    租约已过期的视为被中断，将任务标记为失败并释放准入名额。
+    """
+
+    def __init__(self, workers: int = WORKERS, quick_workers: int = QUICK_WORKERS):
+        self.name = f"{socket.gethostname()}:{os.getpid()}"
+        self.workers = workers
+        self.quick_workers = quick_workers
+        self._stop = threading.Event()
+        self._running = {}
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def start(self):
+        if WARMUP:
+            threading.Thread(target=lambda: get_engine("run").warmup(), daemon=True).start()
+        self._stop.clear()
+        self._threads = [
+            threading.Thread(target=self._consume, args=(QUEUE_KEY, self.workers, self._execute),
+                             name="jobs", daemon=True),
+            threading.Thread(target=self._consume, args=(QUICK_QUEUE_KEY, self.quick_workers, self._execute_quick),
+                             name="jobs-quick", daemon=True),
+            threading.Thread(target=self._heartbeat, name="jobs-heartbeat", daemon=True),
+        ]
+        for t in self._threads:
+            t.start()
+
+    def stop(self, wait: bool = True):
+        """
+        不再取新任务；wait 为 True 时等待正在执行的任务结束。
+        """
+        self._stop.set()
+        if wait:
+            for t in self._threads:
+                t.join()
+
+    def serve(self):
+        """
+        在主线程中运行直到收到 SIGTERM / SIGINT。
+        """
+        signal.signal(signal.SIGTERM, lambda *_: self._stop.set())
+        signal.signal(signal.SIGINT, lambda *_: self._stop.set())
+        self.start()
+        print(f"计算进程 {self.name} 已启动：{self.workers} 个任务线程，{self.quick_workers} 个预览线程")
+        while not self._stop.wait(1):
+            pass
+        print("计算进程正在退出，等待执行中的任务结束")
+        self.stop(wait=True)
+
+    def _consume(self, key: str, n: int, fn):
+        slots = threading.BoundedSemaphore(n)
+        with ThreadPoolExecutor(max_workers=n) as pool:
+            while not self._stop.is_set():
+                if not slots.acquire(timeout=1):
+                    continue
+                try:
+                    got = r.blpop([key], timeout=1)
+                except Exception as e:
+                    print(f"读取任务队列失败: {e}")
+                    got = None
+                    time.sleep(1)
+                if got is None:
+                    slots.release()
+                    continue
+                fut = pool.submit(fn, json.loads(got[1]))
+                fut.add_done_callback(lambda f: slots.release())
+
+    def _execute(self, job: dict):
+        ts = job["task_id"]
+        extra = dict(job.get("status") or {})
+        with self._lock:
+            self._running[ts] = job
+        pipe = r.pipeline()
+        pipe.set(JobQueue.lease_key(ts), self.name, ex=LEASE_TTL)
+        pipe.hset(RUNNING_KEY, ts, json.dumps({**job, "runner": self.name}))
+        pipe.execute()
+        try:
+            set_status(ts, "running", **extra)
+            result = HANDLERS[job["kind"]](ts, job["params"], extra)
+            set_status(ts, "success", **extra, **(result or {}))
+        except Exception as e:
+            traceback.print_exc()
+            set_status(ts, "failed", error=str(e), **extra)
+        finally:
+            with self._lock:
+                self._running.pop(ts, None)
+            pipe = r.pipeline()
+            pipe.delete(JobQueue.lease_key(ts))
+            pipe.hdel(RUNNING_KEY, ts)
+            pipe.execute()
+            Admission.release(job.get("admission"))
+
+    def _execute_quick(self, job: dict):
+        # 等待结果的请求已经超时返回，不再执行
+        if time.time() > job["deadline"]:
+            return
+        try:
+            reply = {"result": QUICK_HANDLERS[job["kind"]](job["params"])}
+        except Exception as e:
+            reply = {"error": str(e), "type": type(e).__name__}
+        pipe = r.pipeline()
+        pipe.rpush(job["reply"], json.dumps(reply))
+        pipe.expire(job["reply"], REPLY_TTL)
+        pipe.execute()
+
+    def _heartbeat(self):
+        interval = max(1, LEASE_TTL // 3)
+        while True:
+            # 退出时继续为仍在执行的任务续约，直到它们全部结束
+            if self._stop.is_set():
+                time.sleep(interval)
+            else:
+                self._stop.wait(interval)
+            with self._lock:
+                running = list(self._running)
+            if self._stop.is_set() and not running:
+                return
+            try:
+                for ts in running:
+                    JobQueue.renew(ts)
+                self.reap(exclude=running)
+            except Exception as e:
+                print(f"任务心跳失败: {e}")
+
+    @classmethod
+    def reap(cls, exclude=()):
+        """
+        将租约已过期（执行它的计算进程已退出）的任务标记为失败，并释放其准入名额。
+        """
+        for ts, raw in r.hgetall(RUNNING_KEY).items():
+            ts = ts.decode()
+            if ts in exclude or JobQueue.is_live(ts):
+                continue
+            job = json.loads(raw)
+            set_status(ts, "failed", error=f"interrupted: compute worker {job.get('runner')} exited",
+                       **(job.get("status") or {}))
+            r.hdel(RUNNING_KEY, ts)
+            Admission.release(job.get("admission"))
+
+
+def run_worker():
+    JobRunner().serve()
+
+
+if __name__ == "__main__":
+    run_worker()